@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Benchmark RAPI round-trip latency with and without pooled cURL handles.
+
+Starts a local HTTPS stand-in for the Ganeti RAPI (self-signed certificate
+created with openssl) and times sequential GetJobStatus calls, first opening
+a new connection per request and then reusing pooled keep-alive handles.
+
+    python benchmarks/rapi_pool.py [--requests 500] [--threads 1]
+"""
+import argparse
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from contrib.ganeti_client import GanetiRapiClient, CurlHandlePool
+
+JOB_STATUS_BODY = ('{"id": 1, "status": "running", "ops": [], '
+                   '"opstatus": ["running"], "opresult": [null]}')
+
+
+class StandInRapiHandler(BaseHTTPRequestHandler):
+    """Answers every request like GET /2/jobs/<id> would."""
+    protocol_version = "HTTP/1.1"
+    # Send each response in one segment, like the real RAPI daemon
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(JOB_STATUS_BODY)))
+        self.end_headers()
+        self.wfile.write(JOB_STATUS_BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInRapiServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_certificate(directory):
+    """Create a throwaway self-signed certificate and return its path."""
+    cert_path = os.path.join(directory, "rapi.pem")
+    subprocess.check_call(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+         "-subj", "/CN=localhost", "-days", "1",
+         "-keyout", cert_path, "-out", cert_path],
+        stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+    return cert_path
+
+
+def start_server(cert_path):
+    server = StandInRapiServer(("127.0.0.1", 0), StandInRapiHandler)
+    server.socket = ssl.wrap_socket(server.socket, certfile=cert_path,
+                                    server_side=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def run(client, requests, threads):
+    """Time GetJobStatus calls, return the per-request latencies."""
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(count):
+        local = []
+        for _ in range(count):
+            start = time.time()
+            client.GetJobStatus(1)
+            local.append(time.time() - start)
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=worker, args=(requests // threads,))
+               for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return sorted(latencies)
+
+
+def report(name, latencies):
+    count = len(latencies)
+    mean = sum(latencies) / count
+    print("%-10s n=%-5d mean=%7.2fms p50=%7.2fms p95=%7.2fms" % (
+        name, count, mean * 1000, latencies[count // 2] * 1000,
+        latencies[int(count * 0.95)] * 1000))
+    return mean
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        server = start_server(make_certificate(tmpdir))
+        port = server.server_address[1]
+
+        pool = CurlHandlePool()
+        unpooled = GanetiRapiClient("127.0.0.1", port=port, curl_pool=False)
+        pooled = GanetiRapiClient("127.0.0.1", port=port, curl_pool=pool)
+        # Warm up both paths once so the first handshake isn't counted
+        unpooled.GetJobStatus(1)
+        pooled.GetJobStatus(1)
+
+        before = report("unpooled", run(unpooled, args.requests, args.threads))
+        after = report("pooled", run(pooled, args.requests, args.threads))
+        print("mean round-trip latency reduced by %.1f%%" %
+              ((1 - after / before) * 100))
+        pool.Close()
+        server.shutdown()
+        server.server_close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    socket.setdefaulttimeout(10)
+    main()
@@ -0,0 +1,119 @@
+"""
+Shared read-through cache for Ganeti reads, kept in redis.
+
+Every cached object (a node, a cluster, a node's instances) is a redis hash
+whose fields are the different column selections it was read with. Entries
+are fresh for CACHE_TTL[kind] seconds. After that they are served stale for
+up to CACHE_STALE_TTL more seconds while a background thread refreshes them.
+
+Tasks call the invalidate_* functions whenever they submit a Ganeti job that
+changes an object, so nodEvac never shows its own changes late.
+"""
+import json
+import threading
+import time
+
+from redis_clients import redis_client
+
+CACHE_KEY = "nodEvac:cache:{kind}:{cluster}:{name}"
+# Cluster-wide invalidation timestamp, entries stored before it are ignored
+CLUSTER_INVALIDATED_KEY = "nodEvac:cache:invalidated:{cluster}"
+REFRESH_LOCK_KEY = CACHE_KEY + ":refresh:{variant}"
+# Time of the last change nodEvac made to a cluster
+CLUSTER_CHANGED_KEY = "nodEvac:cache:changed:{cluster}"
+
+# Seconds an entry is served without refreshing it
+CACHE_TTL = {
+    'node': 15,
+    'node_instances': 15,
+    'cluster': 30,
+}
+# Seconds an expired entry may still be served while it's being refreshed
+CACHE_STALE_TTL = 300
+# Seconds other processes wait before retrying a stuck background refresh
+REFRESH_LOCK_TTL = 30
+
+redis_conn = redis_client('cache')
+
+
+def cached(kind, cluster, name, variant, fetch):
+    """Return a cached value, fetching and storing it if needed.
+
+    @param kind: object type, a key of CACHE_TTL
+    @param variant: string identifying the shape of the value (e.g. fields)
+    @param fetch: callable returning the value from the cluster
+    """
+    entry_key = CACHE_KEY.format(kind=kind, cluster=cluster, name=name)
+    pipe = redis_conn.pipeline()
+    pipe.hget(entry_key, variant)
+    pipe.get(CLUSTER_INVALIDATED_KEY.format(cluster=cluster))
+    raw_entry, invalidated = pipe.execute()
+
+    if raw_entry is not None:
+        entry = json.loads(raw_entry)
+        if invalidated is None or entry["stored"] > float(invalidated):
+            age = time.time() - entry["stored"]
+            if age < CACHE_TTL[kind]:
+                return entry["value"]
+            if age < CACHE_TTL[kind] + CACHE_STALE_TTL:
+                _refresh_in_background(kind, cluster, name, variant, fetch)
+                return entry["value"]
+    return _refresh(kind, entry_key, variant, fetch)
+
+
+def _refresh(kind, entry_key, variant, fetch):
+    # Timestamp taken before the fetch so a concurrent invalidation wins
+    stored = time.time()
+    value = fetch()
+    pipe = redis_conn.pipeline()
+    pipe.hset(entry_key, variant, json.dumps({'stored': stored,
+                                              'value': value}))
+    pipe.expire(entry_key, CACHE_TTL[kind] + CACHE_STALE_TTL)
+    pipe.execute()
+    return value
+
+
+def _refresh_in_background(kind, cluster, name, variant, fetch):
+    """Refresh an entry in a thread, unless another process already is."""
+    lock_key = REFRESH_LOCK_KEY.format(kind=kind, cluster=cluster, name=name,
+                                       variant=variant)
+    if not redis_conn.set(lock_key, 1, nx=True, ex=REFRESH_LOCK_TTL):
+        return
+    entry_key = CACHE_KEY.format(kind=kind, cluster=cluster, name=name)
+    refresh_thread = threading.Thread(target=_refresh,
+                                      args=(kind, entry_key, variant, fetch))
+    refresh_thread.daemon = True
+    refresh_thread.start()
+
+
+def invalidate_node(cluster, node):
+    """Drop everything cached about a node, and the cluster's node list."""
+    _mark_changed(cluster)
+    redis_conn.delete(CACHE_KEY.format(kind='node', cluster=cluster,
+                                       name=node),
+                      CACHE_KEY.format(kind='node_instances', cluster=cluster,
+                                       name=node),
+                      CACHE_KEY.format(kind='cluster', cluster=cluster,
+                                       name=cluster))
+
+
+def invalidate_cluster(cluster):
+    """Drop everything cached about a cluster.
+
+    Used for changes that touch several nodes, e.g. an instance migration.
+    """
+    _mark_changed(cluster)
+    redis_conn.set(CLUSTER_INVALIDATED_KEY.format(cluster=cluster),
+                   time.time(), ex=max(CACHE_TTL.values()) + CACHE_STALE_TTL)
+
+
+def _mark_changed(cluster):
+    redis_conn.set(CLUSTER_CHANGED_KEY.format(cluster=cluster), time.time())
+
+
+def last_change(cluster):
+    """Time of the last change nodEvac made to a cluster, or None."""
+    changed = redis_conn.get(CLUSTER_CHANGED_KEY.format(cluster=cluster))
+    if changed is None:
+        return None
+    return float(changed)
@@ -43,6 +43,7 @@
 # be standalone.
 
 import logging
+import os
 import simplejson
 import socket
 import urllib
@@ -180,6 +181,9 @@ _CURL_SSL_CERT_ERRORS = frozenset([
   _CURLE_SSL_CACERT_BADFILE,
   ])
 
+#: Maximum number of idle cURL handles kept per RAPI endpoint
+CURL_POOL_MAX_IDLE = 8
+
 
 class Error(Exception):
   """Base error class for this module.
@@ -277,6 +281,127 @@ def UsesRapiClient(fn):
   return wrapper
 
 
+class CurlHandlePool(object):
+  """Thread-safe pool of reusable cURL handles for one RAPI endpoint.
+
+  Handles are returned to the pool after each request so libcurl can keep
+  the HTTP connection to the master alive. All handles of a pool are
+  attached to a C{pycurl.CurlShare} object, so DNS lookups and TLS sessions
+  are shared and new connections can resume an existing TLS session instead
+  of doing a full handshake.
+
+  The pool notices when it is used from a forked child process and drops the
+  handles inherited from the parent instead of sharing their connections.
+
+  """
+  def __init__(self, max_idle=CURL_POOL_MAX_IDLE):
+    """Initializes this class.
+
+    @type max_idle: int
+    @param max_idle: maximum number of idle handles kept around
+
+    """
+    self._max_idle = max_idle
+    self._lock = threading.Lock()
+    self._idle = []
+    self._pid = None
+    self._share = None
+
+  @staticmethod
+  def _CreateShare():
+    """Creates the share object used by all handles of this pool.
+
+    """
+    share = pycurl.CurlShare()
+    share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+    # Older pycURL versions can't share TLS sessions
+    if hasattr(pycurl, "LOCK_DATA_SSL_SESSION"):
+      share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+    return share
+
+  def _CheckOwner(self):
+    """Resets the pool if it was inherited through fork(2).
+
+    Must be called with the lock held.
+
+    """
+    pid = os.getpid()
+    if self._pid != pid:
+      # Handles and sessions belong to the parent process, don't touch them
+      self._idle = []
+      self._share = self._CreateShare()
+      self._pid = pid
+
+  def Get(self):
+    """Returns an idle handle, creating a new one if necessary.
+
+    @rtype: pycurl.Curl
+
+    """
+    with self._lock:
+      self._CheckOwner()
+      if self._idle:
+        curl = self._idle.pop()
+        # Drop options of the previous request, live connections, the
+        # session cache and the share are kept (see curl_easy_reset(3))
+        curl.reset()
+      else:
+        curl = pycurl.Curl()
+        curl.setopt(pycurl.SHARE, self._share)
+    return curl
+
+  def Put(self, curl):
+    """Returns a handle to the pool after a successful request.
+
+    @type curl: pycurl.Curl
+    @param curl: handle obtained through L{Get}
+
+    """
+    with self._lock:
+      if self._pid == os.getpid() and len(self._idle) < self._max_idle:
+        self._idle.append(curl)
+        return
+    curl.close()
+
+  def Discard(self, curl):
+    """Closes a handle whose connection is in an unknown state.
+
+    @type curl: pycurl.Curl
+    @param curl: handle obtained through L{Get}
+
+    """
+    curl.close()
+
+  def Close(self):
+    """Closes all idle handles.
+
+    """
+    with self._lock:
+      idle = self._idle
+      self._idle = []
+    for curl in idle:
+      curl.close()
+
+
+_curl_pools = {}
+_curl_pools_lock = threading.Lock()
+
+
+def GetCurlPool(key):
+  """Returns the process-wide cURL handle pool for a RAPI endpoint.
+
+  @type key: string
+  @param key: endpoint identifier, usually the base URL
+  @rtype: L{CurlHandlePool}
+
+  """
+  with _curl_pools_lock:
+    pool = _curl_pools.get(key)
+    if pool is None:
+      pool = _curl_pools[key] = CurlHandlePool()
+    return pool
+
+
 def GenericCurlConfig(verbose=False, use_signal=False,
                       use_curl_cabundle=False, cafile=None, capath=None,
                       proxy=None, verify_hostname=False,
@@ -388,7 +513,7 @@ class GanetiRapiClient(object): # pylint: disable=R0904
 
   def __init__(self, host, port=GANETI_RAPI_PORT,
                username=None, password=None, logger=logging,
-               curl_config_fn=None, curl_factory=None):
+               curl_config_fn=None, curl_factory=None, curl_pool=None):
     """Initializes this class.
 
     @type host: string
@@ -401,6 +526,10 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     @param password: the password to connect with
     @type curl_config_fn: callable
     @param curl_config_fn: Function to configure C{pycurl.Curl} object
+    @type curl_pool: L{CurlHandlePool} or bool
+    @param curl_pool: Pool to take cURL handles from; C{None} uses the shared
+        pool of this endpoint and C{False} creates a new handle per request.
+        Ignored if C{curl_factory} is given.
     @param logger: Logging object
 
     """
@@ -418,6 +547,13 @@ class GanetiRapiClient(object): # pylint: disable=R0904
 
     self._base_url = "https://%s" % address
 
+    if curl_factory or curl_pool is False:
+      self._curl_pool = None
+    elif curl_pool is None:
+      self._curl_pool = GetCurlPool(self._base_url)
+    else:
+      self._curl_pool = curl_pool
+
     if username is not None:
       if password is None:
         raise Error("Password not specified")
@@ -431,6 +567,8 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     # Create pycURL object if no factory is provided
     if self._curl_factory:
       curl = self._curl_factory()
+    elif self._curl_pool:
+      curl = self._curl_pool.Get()
     else:
       curl = pycurl.Curl()
 
@@ -440,6 +578,10 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     curl.setopt(pycurl.MAXREDIRS, 5)
     curl.setopt(pycurl.NOSIGNAL, True)
     curl.setopt(pycurl.USERAGENT, self.USER_AGENT)
+    # Keep idle connections to the master open between requests
+    curl.setopt(pycurl.FORBID_REUSE, False)
+    if hasattr(pycurl, "TCP_KEEPALIVE"):
+      curl.setopt(pycurl.TCP_KEEPALIVE, 1)
     curl.setopt(pycurl.SSL_VERIFYHOST, 0)
     curl.setopt(pycurl.SSL_VERIFYPEER, False)
     curl.setopt(pycurl.HTTPHEADER, [
@@ -462,6 +604,22 @@ class GanetiRapiClient(object): # pylint: disable=R0904
 
     return curl
 
+  def _ReleaseCurl(self, curl, reusable):
+    """Hands a cURL object back after a request.
+
+    @type reusable: bool
+    @param reusable: whether the request completed and the connection can be
+        used for further requests
+
+    """
+    if not self._curl_pool:
+      return
+
+    if reusable:
+      self._curl_pool.Put(curl)
+    else:
+      self._curl_pool.Discard(curl)
+
   @staticmethod
   def _EncodeQuery(query):
     """Encode query values for RAPI URL.
@@ -511,6 +669,27 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     @raises CertificateError: If an invalid SSL certificate is found
     @raises GanetiApiError: If an invalid response is returned
 
+    """
+    request = self._PrepareRequest(method, path, query, content)
+    curl_error = None
+
+    # Send request and wait for response
+    try:
+      request[0].perform()
+    except pycurl.error, err:
+      curl_error = err.args
+
+    return self.FinishRequest(request, curl_error=curl_error)
+
+  def _PrepareRequest(self, method, path, query, content):
+    """Prepares a cURL object for an HTTP request without performing it.
+
+    See L{_SendRequest} for the parameters.
+
+    @rtype: tuple
+    @return: (cURL object, response buffer), to be passed to L{FinishRequest}
+             once the transfer is done
+
     """
     assert path.startswith("/")
 
@@ -541,24 +720,44 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     curl.setopt(pycurl.POSTFIELDS, str(encoded_content))
     curl.setopt(pycurl.WRITEFUNCTION, encoded_resp_body.write)
 
+    return (curl, encoded_resp_body)
+
+  def FinishRequest(self, request, curl_error=None):
+    """Processes the response of a performed request.
+
+    This is the second half of L{_SendRequest} and can be used for requests
+    that were performed elsewhere, e.g. by a C{pycurl.CurlMulti} loop.
+
+    @type request: tuple
+    @param request: request as returned by L{_PrepareRequest}
+    @type curl_error: tuple or None
+    @param curl_error: (cURL error code, message) if the transfer failed
+
+    @return: JSON-Decoded response
+
+    @raises CertificateError: If an invalid SSL certificate is found
+    @raises GanetiApiError: If an invalid response is returned
+
+    """
+    (curl, encoded_resp_body) = request
+
     try:
-      # Send request and wait for response
-      try:
-        curl.perform()
-      except pycurl.error, err:
-        if err.args[0] in _CURL_SSL_CERT_ERRORS:
-          raise CertificateError("SSL certificate error %s" % err,
-                                 code=err.args[0])
-
-        raise GanetiApiError(str(err), code=err.args[0])
+      if curl_error is not None:
+        code = curl_error[0]
+        if code in _CURL_SSL_CERT_ERRORS:
+          raise CertificateError("SSL certificate error %s" % (curl_error, ),
+                                 code=code)
+
+        raise GanetiApiError(str(curl_error), code=code)
+
+      # Get HTTP response code
+      http_code = curl.getinfo(pycurl.RESPONSE_CODE)
     finally:
       # Reset settings to not keep references to large objects in memory
       # between requests
       curl.setopt(pycurl.POSTFIELDS, "")
       curl.setopt(pycurl.WRITEFUNCTION, lambda _: None)
-
-    # Get HTTP response code
-    http_code = curl.getinfo(pycurl.RESPONSE_CODE)
+      self._ReleaseCurl(curl, curl_error is None)
 
     # Was anything written to the response buffer?
     if encoded_resp_body.tell():
@@ -1339,7 +1538,8 @@ class GanetiRapiClient(object): # pylint: disable=R0904
                               (GANETI_RAPI_VERSION, instance)), query, body)
 
   def MigrateInstance(self, instance, mode=None, cleanup=None,
-                      target_node=None, reason=None, allow_failover=None):
+                      target_node=None, reason=None, allow_failover=None,
+                      iallocator=None):
     """Migrates an instance.
 
     @type instance: string
@@ -1354,6 +1554,9 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     @param reason: the reason for executing this operation
     @type allow_failover: bool
     @param allow_failover: Whether to use failover if migration not possible
+    @type iallocator: string
+    @param iallocator: Iallocator for deciding the target node for
+      externally mirrored instances
     @rtype: string
     @return: job id
 
@@ -1363,6 +1566,7 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     _SetItemIf(body, cleanup is not None, "cleanup", cleanup)
     _SetItemIf(body, target_node is not None, "target_node", target_node)
     _SetItemIf(body, allow_failover is not None, "allow_failover", allow_failover)
+    _SetItemIf(body, iallocator is not None, "iallocator", iallocator)
 
     query = []
     _AppendReason(query, reason)
@@ -1535,6 +1739,31 @@ class GanetiRapiClient(object): # pylint: disable=R0904
       C{job_info} and C{log_entries} otherwise.
     @rtype: dict
 
+    """
+    return self._SendRequest(*self._WaitForJobChangeArgs(job_id, fields,
+                                                         prev_job_info,
+                                                         prev_log_serial))
+
+  def PrepareWaitForJobChange(self, job_id, fields, prev_job_info,
+                              prev_log_serial):
+    """Prepares a L{WaitForJobChange} request without sending it.
+
+    Used to wait for many jobs at once with a C{pycurl.CurlMulti} loop. The
+    transfer is performed by the caller, which then passes the request to
+    L{FinishRequest} to get the same result L{WaitForJobChange} would return.
+
+    @rtype: tuple
+    @return: (cURL object, response buffer)
+
+    """
+    return self._PrepareRequest(*self._WaitForJobChangeArgs(job_id, fields,
+                                                            prev_job_info,
+                                                            prev_log_serial))
+
+  @staticmethod
+  def _WaitForJobChangeArgs(job_id, fields, prev_job_info, prev_log_serial):
+    """Builds the request arguments for L{WaitForJobChange}.
+
     """
     body = {
       "fields": fields,
@@ -1542,9 +1771,8 @@ class GanetiRapiClient(object): # pylint: disable=R0904
       "previous_log_serial": prev_log_serial,
       }
 
-    return self._SendRequest(HTTP_GET,
-                             "/%s/jobs/%s/wait" % (GANETI_RAPI_VERSION, job_id),
-                             None, body)
+    return (HTTP_GET, "/%s/jobs/%s/wait" % (GANETI_RAPI_VERSION, job_id),
+            None, body)
 
   def CancelJob(self, job_id, dry_run=False):
     """Cancels a job.
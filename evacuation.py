@@ -0,0 +1,249 @@
+"""
+Evacuation records kept in redis.
+
+An evacuation runs as several Celery tasks (see tasks.evacuate_node_task), so
+its state lives in a redis hash named after the id of the task that started
+it, rather than in the meta of any one task. Every field holds a JSON value:
+
+    node_name, cluster_name
+    node_names  every evacuated node, for batch evacuations (node_name is
+              None then, see tasks.evacuate_nodes_task)
+    options   the evacuate_node(s)_task arguments, to resume it with
+    state     E_STARTED, E_DRAINED, E_MIGRATING, E_OFFLINING, SUCCESS or
+              FAILURE
+    status    role, pinst_cnt, inst_done, inst_failed, engine and order
+    heartbeat time any task last worked on the evacuation
+    tasks     instance name to its migrate_instance_task id (nodevac engine)
+
+Each finished step is checkpointed in the record too, so an evacuation
+whose worker died picks up where it stopped: tagged, drained, instances
+(the planned migration order), migrate_node_job and offlined. The Ganeti
+job of every migration is recorded in a second hash (see claim_migration),
+so resumed migrations follow their job instead of migrating again.
+
+The progress of every migration is kept apart, one field per instance, and
+versioned so readers can ask only for what changed (see update_progress).
+
+Nodes are locked for their evacuation with a lease (see lease.py) renewed by
+every heartbeat, so the lock of an evacuation that died goes away by itself.
+"""
+import json
+import time
+
+from jobs import finish_job
+from lease import acquire_leases, renew_leases, release_leases
+from progress import notify_progress
+from redis_clients import redis_client, dump_fields, load_fields
+
+EVACUATION_KEY = "nodEvac:evacuation:{evacuation_id}"
+# Id of the evacuation running on a node
+NODE_EVACUATION_KEY = "nodEvac:evacuate_node:{cluster}:{node}"
+EVACUATION_JOBS_KEY = EVACUATION_KEY + ":jobs"
+# Instance name to the JSON progress entry of its migration
+EVACUATION_PROGRESS_KEY = EVACUATION_KEY + ":progress"
+# Instance names scored with the progress version of their last change
+PROGRESS_VERSIONS_KEY = EVACUATION_PROGRESS_KEY + ":versions"
+# Seconds the record of a finished evacuation is kept
+EVACUATION_TTL = 86400
+# Seconds without a heartbeat after which an evacuation is resumed when it's
+# triggered again
+EVACUATION_STALL_TIMEOUT = 900
+# Seconds a node stays locked for an evacuation without a heartbeat, longer
+# than EVACUATION_STALL_TIMEOUT so a stalled evacuation is found and resumed
+EVACUATION_LOCK_TTL = 2 * EVACUATION_STALL_TIMEOUT
+# Seconds after which a migration claimed but never submitted may be retried
+MIGRATION_CLAIM_TIMEOUT = 60
+FINAL_STATES = ('SUCCESS', 'FAILURE')
+
+redis_conn = redis_client('state')
+
+# Store the progress entries that changed under the next version, returns
+# the version, or nothing if no entry changed
+_UPDATE_PROGRESS_SCRIPT = redis_conn.register_script("""
+local changed = {}
+for i = 1, #ARGV, 2 do
+    if redis.call('HGET', KEYS[1], ARGV[i]) ~= ARGV[i + 1] then
+        table.insert(changed, i)
+    end
+end
+if #changed == 0 then
+    return false
+end
+local last = redis.call('ZREVRANGE', KEYS[2], 0, 0, 'WITHSCORES')
+local version = (tonumber(last[2]) or 0) + 1
+for _, i in ipairs(changed) do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    redis.call('ZADD', KEYS[2], version, ARGV[i])
+end
+return version
+""")
+
+
+def update_evacuation(evacuation_id, **fields):
+    """Store the given fields of an evacuation record, and a heartbeat."""
+    fields["heartbeat"] = time.time()
+    redis_conn.hmset(EVACUATION_KEY.format(evacuation_id=evacuation_id),
+                     dump_fields(fields))
+    _renew_node_locks(evacuation_id)
+    notify_progress(evacuation_id)
+
+
+def get_evacuation(evacuation_id):
+    """Return an evacuation record as a dict, or None."""
+    return load_fields(redis_conn.hgetall(
+        EVACUATION_KEY.format(evacuation_id=evacuation_id)))
+
+
+def end_evacuation(evacuation_id, state, **fields):
+    """
+    Store the final state of an evacuation, let its record expire and free
+    its node for the next evacuation.
+    """
+    evacuation_key = EVACUATION_KEY.format(evacuation_id=evacuation_id)
+    update_evacuation(evacuation_id, state=state, **fields)
+    evacuation = get_evacuation(evacuation_id)
+    pipe = redis_conn.pipeline()
+    pipe.expire(evacuation_key, EVACUATION_TTL)
+    for key in (EVACUATION_JOBS_KEY, EVACUATION_PROGRESS_KEY,
+                PROGRESS_VERSIONS_KEY):
+        pipe.expire(key.format(evacuation_id=evacuation_id), EVACUATION_TTL)
+    pipe.execute()
+    release_leases(_node_lock_keys(evacuation), evacuation_id)
+    finish_job(evacuation_id, state)
+
+
+def evacuated_nodes(evacuation):
+    """Return the names of the nodes an evacuation empties."""
+    return evacuation.get("node_names") or [evacuation["node_name"]]
+
+
+def _node_lock_keys(evacuation):
+    return [NODE_EVACUATION_KEY.format(cluster=evacuation["cluster_name"],
+                                       node=node)
+            for node in evacuated_nodes(evacuation)]
+
+
+def lock_nodes(cluster, node_names, evacuation_id):
+    """Lock nodes for an evacuation, for EVACUATION_LOCK_TTL seconds.
+
+    Either every node is locked or, if one of them already has an
+    evacuation, none is.
+
+    @return: None on success, else the id of an evacuation already running
+        on one of the nodes
+    """
+    return acquire_leases([NODE_EVACUATION_KEY.format(cluster=cluster,
+                                                      node=node)
+                           for node in node_names],
+                          evacuation_id, EVACUATION_LOCK_TTL)
+
+
+def _renew_node_locks(evacuation_id):
+    cluster_name, node_name, node_names = redis_conn.hmget(
+        EVACUATION_KEY.format(evacuation_id=evacuation_id),
+        'cluster_name', 'node_name', 'node_names')
+    if cluster_name is None:
+        return
+    evacuation = {'cluster_name': json.loads(cluster_name),
+                  'node_name': json.loads(node_name or 'null'),
+                  'node_names': json.loads(node_names or 'null')}
+    renew_leases(_node_lock_keys(evacuation), evacuation_id,
+                 EVACUATION_LOCK_TTL)
+
+
+def touch_evacuation(evacuation_id):
+    """Record a heartbeat for a running evacuation, renewing its locks."""
+    evacuation_key = EVACUATION_KEY.format(evacuation_id=evacuation_id)
+    if redis_conn.exists(evacuation_key):
+        redis_conn.hset(evacuation_key, 'heartbeat', json.dumps(time.time()))
+        _renew_node_locks(evacuation_id)
+
+
+def is_stalled(evacuation):
+    """Whether an unfinished evacuation has had no heartbeat for a while."""
+    return (evacuation["state"] not in FINAL_STATES and
+            time.time() - evacuation["heartbeat"] > EVACUATION_STALL_TIMEOUT)
+
+
+def update_progress(evacuation_id, progress):
+    """Store the progress of some of an evacuation's migrations.
+
+    Entries equal to the stored ones are skipped. Those that changed are
+    stored together under a new version, one more than the last.
+
+    @param progress: dict of instance name to its progress entry
+    @return: the new version, or None if nothing changed
+    """
+    args = []
+    for instance, entry in progress.items():
+        args.extend([instance, json.dumps(entry, sort_keys=True)])
+    if not args:
+        return None
+    version = _UPDATE_PROGRESS_SCRIPT(
+        keys=[EVACUATION_PROGRESS_KEY.format(evacuation_id=evacuation_id),
+              PROGRESS_VERSIONS_KEY.format(evacuation_id=evacuation_id)],
+        args=args)
+    if version:
+        notify_progress(evacuation_id)
+    return version
+
+
+def get_progress(evacuation_id, since=0):
+    """Read the progress of an evacuation's migrations.
+
+    @param since: a version returned before, to know what changed after it
+    @return: (version, progress, changed): the last version, the progress
+        entry of every instance and the instances whose entry changed after
+        `since`
+    """
+    pipe = redis_conn.pipeline()
+    pipe.hgetall(EVACUATION_PROGRESS_KEY.format(evacuation_id=evacuation_id))
+    pipe.zrange(PROGRESS_VERSIONS_KEY.format(evacuation_id=evacuation_id),
+                0, -1, withscores=True)
+    progress, versions = pipe.execute()
+    progress = dict((instance, json.loads(entry))
+                    for instance, entry in progress.items())
+    version = int(versions[-1][1]) if versions else 0
+    changed = [instance for instance, changed_in in versions
+               if changed_in > since]
+    return version, progress, changed
+
+
+def claim_migration(evacuation_id, instance):
+    """Claim the migration of an instance for the calling task.
+
+    @return: None if the claim succeeded, else the existing claim, a dict
+        with the claim time and the Ganeti job id (None until submitted)
+    """
+    jobs_key = EVACUATION_JOBS_KEY.format(evacuation_id=evacuation_id)
+    if redis_conn.hsetnx(jobs_key, instance,
+                         json.dumps({'claimed': time.time(), 'job_id': None})):
+        return None
+    return get_migration_job(evacuation_id, instance)
+
+
+def get_migration_job(evacuation_id, instance):
+    """Return the claim of an instance's migration, or None."""
+    migration = redis_conn.hget(
+        EVACUATION_JOBS_KEY.format(evacuation_id=evacuation_id), instance)
+    if migration is None:
+        return None
+    return json.loads(migration)
+
+
+def update_migration_claim(evacuation_id, instance, **fields):
+    """Renew the claim of an instance's migration, storing the given fields.
+
+    Fields are job_id, the migration job, and secondary_job_id, the job that
+    first moves its DRBD secondary.
+    """
+    migration = get_migration_job(evacuation_id, instance) or {'job_id': None}
+    migration.update(fields, claimed=time.time())
+    redis_conn.hset(EVACUATION_JOBS_KEY.format(evacuation_id=evacuation_id),
+                    instance, json.dumps(migration))
+
+
+def record_migration_job(evacuation_id, instance, job_id):
+    """Checkpoint the Ganeti job migrating an instance."""
+    update_migration_claim(evacuation_id, instance, job_id=job_id)
+
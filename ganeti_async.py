@@ -0,0 +1,80 @@
+"""
+Concurrent Ganeti RAPI access.
+
+AsyncGanetiClient exposes the RAPI calls nodEvac uses, but every call returns
+a concurrent.futures.Future instead of blocking, so independent calls (and
+calls to different clusters) overlap. Results have the same shape as the
+corresponding GanetiRapiClient method.
+
+    cluster = AsyncGanetiClient(cluster_name)
+    info_future, nodes_future = cluster.GetInfo(), cluster.GetNodes(bulk=True)
+    cluster_info = info_future.result()
+
+Calls run on a shared thread pool, using the per-cluster clients from
+ganeti_utils and their pooled connections.
+"""
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Module import, ganeti_utils imports this module in turn
+import ganeti_utils
+
+# Maximum number of RAPI requests in flight per process
+RAPI_WORKERS = 16
+
+ASYNC_METHODS = frozenset([
+    'GetInfo',
+    'GetNodes',
+    'GetNode',
+    'GetInstance',
+    'GetInstances',
+    'MigrateInstance',
+    'SetNodeRole',
+    'GetNodeTags',
+    'AddNodeTags',
+    'DeleteNodeTags',
+    'GetJobs',
+    'GetJobStatus',
+    'WaitForJobChange',
+    'Query',
+    'QueryFields',
+])
+
+_EXECUTOR = {}
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def get_executor():
+    """Return the process-wide RAPI executor, creating it after a fork."""
+    with _EXECUTOR_LOCK:
+        executor = _EXECUTOR.get(os.getpid())
+        if executor is None:
+            _EXECUTOR.clear()
+            executor = _EXECUTOR[os.getpid()] = ThreadPoolExecutor(
+                max_workers=RAPI_WORKERS)
+        return executor
+
+
+class AsyncGanetiClient(object):
+    """Future-returning view of a cluster's shared GanetiRapiClient."""
+
+    def __init__(self, cluster_name, executor=None):
+        self.cluster_name = cluster_name
+        self._executor = executor
+
+    def __getattr__(self, name):
+        if name not in ASYNC_METHODS:
+            raise AttributeError(name)
+
+        def submit(*args, **kwargs):
+            executor = self._executor or get_executor()
+            return executor.submit(self._call, name, args, kwargs)
+        submit.__name__ = name
+        return submit
+
+    def _call(self, name, args, kwargs):
+        # Looked up in the worker so credential changes are picked up
+        cluster_conn = ganeti_utils.cluster_connection(self.cluster_name)
+        return getattr(cluster_conn, name)(*args, **kwargs)
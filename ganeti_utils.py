@@ -1,5 +1,12 @@
 """Helper functions for Ganeti related operations"""
-from contrib.ganeti_client import GanetiRapiClient
+import os
+import threading
+
+from contrib.ganeti_client import GanetiRapiClient, GanetiApiError,\
+        HTTP_NOT_FOUND, JOB_STATUS_FINALIZED, JOB_STATUS_SUCCESS
+import cache
+import ganeti_async
+import snapshot
 
 # Read cluster credentials from external file (dictionary in python file)
 #  Example cluster config
@@ -17,48 +24,202 @@ GNTNODE_ROLE_DESC = {
     'M': 'Master',
 }
 
+# Columns fetched through the query API for each view, keep these in sync
+# with what the templates and tasks read
+NODE_INFO_FIELDS = ["name", "role", "tags", "pinst_cnt", "pinst_list"]
+CLUSTER_NODE_FIELDS = ["name", "pinst_cnt"]
+INSTANCE_INFO_FIELDS = ["name", "pnode", "snodes", "admin_state",
+                        "disk_template", "be/maxmem", "tags"]
+
+# Ganeti query result status for a field with a valid value
+QRFS_NORMAL = 0
+
+
+# Long-lived clients, one per cluster: {cluster_name: (credentials, client)}
+_CLUSTER_CLIENTS = {}
+_CLUSTER_CLIENTS_LOCK = threading.Lock()
+_CLUSTER_CLIENTS_PID = os.getpid()
+
 
 def cluster_connection(cluster_name):
-    """Establishes a cluster connection.
+    """Returns the shared connection for a cluster.
     Cluster name must be befined, as called, in the GANETI_CLUSTER dict.
 
+    Clients are created on first use and kept for the lifetime of the process,
+    so their pooled RAPI connections are reused across calls. A client is
+    rebuilt if the credentials in GANETI_CLUSTER change, and all clients are
+    dropped in a forked child (e.g. a prefork Celery worker).
+
     @return: GanetiRapiClient object
 
     """
     # TODO this returns KeyError if cluster_name doesn't exist in dict
     cluster_info = GANETI_CLUSTER[cluster_name]
-    cluster_conn = GanetiRapiClient(cluster_name,
-                                    username=cluster_info["username"],
-                                    password=cluster_info["password"]
-                                   )
+    credentials = (cluster_info["username"], cluster_info["password"])
+    with _CLUSTER_CLIENTS_LOCK:
+        if _CLUSTER_CLIENTS_PID != os.getpid():
+            _reset_cluster_connections()
+        cached = _CLUSTER_CLIENTS.get(cluster_name)
+        if cached is not None and cached[0] == credentials:
+            return cached[1]
+        cluster_conn = GanetiRapiClient(cluster_name,
+                                        username=credentials[0],
+                                        password=credentials[1]
+                                       )
+        _CLUSTER_CLIENTS[cluster_name] = (credentials, cluster_conn)
     return cluster_conn
 
-def get_node_instances(node, cluster):
+
+def reset_cluster_connections():
+    """Forget all shared cluster connections.
+
+    Called in every new worker process so no client is shared across fork.
+    """
+    with _CLUSTER_CLIENTS_LOCK:
+        _reset_cluster_connections()
+
+
+def _reset_cluster_connections():
+    global _CLUSTER_CLIENTS_PID
+    _CLUSTER_CLIENTS.clear()
+    _CLUSTER_CLIENTS_PID = os.getpid()
+
+def wait_for_job(cluster_conn, job_id, on_change=None,
+                 fields=("status", "opstatus"), on_wait=None):
+    """Block until a Ganeti job is finalized.
+
+    Uses the RAPI long-poll endpoint (WaitForJobChange): every request returns
+    as soon as the job changes or logs something, or after the server-side
+    timeout if nothing happened, so there's no dead time between polls.
+
+    @param on_change: callable(job_info, log_entries) called on every change,
+        job_info is a dict of the requested fields and log_entries a list of
+        new (serial, timestamp, type, message) job log entries
+    @param on_wait: callable() called after every long-poll that timed out
+        without changes, e.g. to show that a quiet job is still followed
+    @return: True if the job succeeded, False otherwise
+    """
+    fields = list(fields)
+    if "status" not in fields:
+        fields.insert(0, "status")
+    prev_job_info = None
+    prev_log_serial = None
+    while True:
+        result = cluster_conn.WaitForJobChange(job_id, fields, prev_job_info,
+                                               prev_log_serial)
+        if not result:
+            # Server-side timeout without changes, wait again
+            if on_wait is not None:
+                on_wait()
+            continue
+        log_entries = result["log_entries"] or []
+        if log_entries:
+            prev_log_serial = max(entry[0] for entry in log_entries)
+        job_info = dict(zip(fields, result["job_info"]))
+        if on_change is not None:
+            on_change(job_info, log_entries)
+        if job_info["status"] in JOB_STATUS_FINALIZED:
+            return job_info["status"] == JOB_STATUS_SUCCESS
+        prev_job_info = result["job_info"]
+
+
+def query_result_to_dicts(fields, query_result):
+    """Convert a Ganeti query result to a list of dicts.
+
+    Values the cluster couldn't provide (e.g. live data of offline nodes)
+    are returned as None.
+    """
+    return [dict((field, value if status == QRFS_NORMAL else None)
+                 for field, (status, value) in zip(fields, row))
+            for row in query_result["data"]]
+
+
+def query_resource(cluster, resource, fields, qfilter=None):
+    """Fetch only the given fields of a resource through the query API.
+
+    @param resource: Ganeti query resource, e.g. "node" or "instance"
+    @param qfilter: optional Ganeti query filter, evaluated by the master
+    @return: list of dicts
+    """
     cluster_conn = cluster_connection(cluster)
-    node_info = cluster_conn.GetNode(node)
+    query_result = cluster_conn.Query(resource, fields, qfilter=qfilter)
+    return query_result_to_dicts(fields, query_result)
+
+
+def _project(record, fields):
+    """Pick fields out of a snapshot record, None if it lacks any of them."""
+    if record is None or not set(fields) <= set(record):
+        return None
+    return dict((field, record[field]) for field in fields)
+
+
+def _expand_role(node_info):
     # Expand the role from a single letter designation to human readable format
-    node_info["role"] = GNTNODE_ROLE_DESC[node_info['role']]
+    if "role" in node_info:
+        node_info["role"] = GNTNODE_ROLE_DESC[node_info['role']]
     return node_info
 
 
-def get_node_info(node, cluster):
+def get_node_info(node, cluster, fields=NODE_INFO_FIELDS, use_cache=False):
     """Fetch node info from the specified cluster.
 
+    @param use_cache: allow an answer from the cluster snapshot or the cache,
+        which may be a few seconds old. Meant for views.
     @return: dict
     """
-    cluster_conn = cluster_connection(cluster)
-    node_info = cluster_conn.GetNode(node)
-    # Expand the role from a single letter designation to human readable format
-    node_info["role"] = GNTNODE_ROLE_DESC[node_info['role']]
-    return node_info
+    if use_cache:
+        if snapshot.is_usable(cluster):
+            node_info = _project(snapshot.get_node(cluster, node), fields)
+            if node_info is not None:
+                return _expand_role(node_info)
+        return cache.cached('node', cluster, node, ",".join(fields),
+                            lambda: get_node_info(node, cluster, fields))
+    nodes = query_resource(cluster, "node", fields, ["=", "name", node])
+    if not nodes:
+        raise GanetiApiError("Node '%s' not found" % node,
+                             code=HTTP_NOT_FOUND)
+    return _expand_role(nodes[0])
 
-def get_cluster_info(cluster):
+def get_node_instances(node, cluster, fields=INSTANCE_INFO_FIELDS,
+                       use_cache=False):
+    """Fetch info about the primary instances of a node in one query.
+
+    @param use_cache: allow an answer from the cluster snapshot or the cache,
+        which may be a few seconds old. Meant for views and planners.
+    @return: list of dicts
+    """
+    if use_cache:
+        if snapshot.is_usable(cluster):
+            instances = [_project(instance, fields) for instance in
+                         snapshot.get_snapshot(cluster, 'instance').values()
+                         if instance["pnode"] == node]
+            if None not in instances:
+                return instances
+        return cache.cached('node_instances', cluster, node, ",".join(fields),
+                            lambda: get_node_instances(node, cluster, fields))
+    return query_resource(cluster, "instance", fields, ["=", "pnode", node])
+
+def get_cluster_info(cluster, node_filter=None, use_cache=False):
     """ Fetch cluster info from the specified cluster.
 
+    @param node_filter: optional Ganeti query filter for the node list
+    @param use_cache: allow an answer from the cluster snapshot or the cache,
+        which may be a few seconds old. Meant for views.
     @return: dict
     """
-    cluster_conn = cluster_connection(cluster)
-    cluster_info = cluster_conn.GetInfo(cluster)
-    nodes_list = cluster_conn.GetNodes(bulk=True)
-    cluster_info["nodes"] = nodes_list
+    if use_cache:
+        if node_filter is None and snapshot.is_usable(cluster):
+            cluster_info = snapshot.get_cluster_info(cluster)
+            cluster_info["nodes"] = [_project(node, CLUSTER_NODE_FIELDS)
+                                     for node in snapshot.get_nodes(cluster)]
+            return cluster_info
+        return cache.cached('cluster', cluster, cluster, repr(node_filter),
+                            lambda: get_cluster_info(cluster, node_filter))
+    cluster_conn = ganeti_async.AsyncGanetiClient(cluster)
+    cluster_info_future = cluster_conn.GetInfo(cluster)
+    nodes_future = cluster_conn.Query("node", CLUSTER_NODE_FIELDS,
+                                      qfilter=node_filter)
+    cluster_info = cluster_info_future.result()
+    cluster_info["nodes"] = query_result_to_dicts(CLUSTER_NODE_FIELDS,
+                                                  nodes_future.result())
     return cluster_info
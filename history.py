@@ -0,0 +1,165 @@
+"""
+History of finished migrations, and evacuation time estimates based on it.
+
+Every migration nodEvac runs is recorded in the state redis, shared by the
+workers of every host and the web app: how long its Ganeti job took, the
+instance's memory, disks and disk template, where it went and whether it
+worked. Records are indexed by end time in HISTORY_KEY and kept
+HISTORY_DAYS days. The memory and duration of the last ESTIMATE_SAMPLES
+successful migrations of each disk template are also kept in a list, the
+samples the estimates read.
+
+estimate_duration() fits migration time against instance memory for a disk
+template, and estimate_evacuation() turns that into the time left for a set
+of migrations run a few at a time.
+"""
+import json
+import logging
+import time
+
+from redis import RedisError
+
+from redis_clients import redis_client
+
+# Sorted set of JSON migration records, scored by end time
+HISTORY_KEY = "nodEvac:history:migrations"
+# List of JSON [memory, duration, end time] of the successful migrations of
+# a disk template, newest first
+HISTORY_SAMPLES_KEY = "nodEvac:history:samples:{disk_template}"
+# Days of history kept
+HISTORY_DAYS = 180
+# Most recent successful migrations an estimate is based on
+ESTIMATE_SAMPLES = 200
+# Seconds assumed for a migration when there's no history to go by
+DEFAULT_DURATION = 120
+
+redis_conn = redis_client('state')
+
+
+def job_timestamp(timestamp):
+    """Convert a Ganeti job timestamp ([seconds, microseconds]) to a float."""
+    if not timestamp:
+        return None
+    return timestamp[0] + timestamp[1] / 1000000.0
+
+
+def record_migration(cluster, instance_info, job_details, target, success):
+    """Store a finished migration.
+
+    The history is only informative, failing to store it is logged but
+    doesn't raise.
+
+    @param instance_info: the instance before the migration, with its pnode,
+        disk_template, be/maxmem and disk.sizes
+    @param job_details: the migration job, as returned by GetJobStatus
+    """
+    start_ts = job_timestamp(job_details.get("start_ts"))
+    end_ts = job_timestamp(job_details.get("end_ts")) or time.time()
+    duration = end_ts - start_ts if start_ts is not None else None
+    memory = instance_info.get("be/maxmem")
+    record = {
+        'cluster': cluster,
+        'instance': instance_info.get("name"),
+        'job_id': job_details.get("id"),
+        'source': instance_info.get("pnode"),
+        'target': target,
+        'disk_template': instance_info.get("disk_template"),
+        'memory': memory,
+        'disk': sum(instance_info.get("disk.sizes") or []),
+        'start_ts': start_ts,
+        'end_ts': end_ts,
+        'duration': duration,
+        'success': bool(success),
+    }
+    pipe = redis_conn.pipeline()
+    pipe.zadd(HISTORY_KEY, end_ts, json.dumps(record, sort_keys=True))
+    pipe.zremrangebyscore(HISTORY_KEY, 0,
+                          time.time() - HISTORY_DAYS * 86400)
+    if success and duration is not None and memory is not None:
+        samples_key = HISTORY_SAMPLES_KEY.format(
+            disk_template=record["disk_template"])
+        pipe.lpush(samples_key, json.dumps([memory, duration, end_ts]))
+        pipe.ltrim(samples_key, 0, ESTIMATE_SAMPLES - 1)
+    try:
+        pipe.execute()
+    except RedisError as error:
+        logging.warning("Can't record the migration of %s: %s",
+                        instance_info.get("name"), error)
+
+
+def get_models(disk_templates):
+    """Fit duration = base + per_mb * memory for each disk template.
+
+    Falls back to the mean duration when memory doesn't vary, and to
+    DEFAULT_DURATION without any history, or if it can't be read.
+
+    @return: dict of disk template to a (base, per_mb) pair
+    """
+    disk_templates = list(set(disk_templates))
+    pipe = redis_conn.pipeline(transaction=False)
+    for disk_template in disk_templates:
+        pipe.lrange(HISTORY_SAMPLES_KEY.format(disk_template=disk_template),
+                    0, ESTIMATE_SAMPLES - 1)
+    try:
+        sample_lists = pipe.execute()
+    except RedisError as error:
+        logging.warning("Can't read the migration history: %s", error)
+        sample_lists = [[] for _ in disk_templates]
+    oldest = time.time() - HISTORY_DAYS * 86400
+    models = {}
+    for disk_template, samples in zip(disk_templates, sample_lists):
+        samples = [json.loads(sample) for sample in samples]
+        models[disk_template] = _fit([(memory, duration)
+                                      for memory, duration, end_ts in samples
+                                      if end_ts >= oldest])
+    return models
+
+
+def _fit(samples):
+    """Least squares line through (memory, duration) samples."""
+    if not samples:
+        return (DEFAULT_DURATION, 0.0)
+    count = float(len(samples))
+    mean_memory = sum(memory for memory, _ in samples) / count
+    mean_duration = sum(duration for _, duration in samples) / count
+    variance = sum((memory - mean_memory) ** 2 for memory, _ in samples)
+    if not variance:
+        return (mean_duration, 0.0)
+    per_mb = sum((memory - mean_memory) * (duration - mean_duration)
+                 for memory, duration in samples) / variance
+    # A negative slope is noise, memory never makes migrations faster
+    per_mb = max(per_mb, 0.0)
+    return (mean_duration - per_mb * mean_memory, per_mb)
+
+
+def estimate_duration(instance_info, models):
+    """Seconds a migration of the instance should take, see get_models()."""
+    base, per_mb = models.get(instance_info.get("disk_template"),
+                              (DEFAULT_DURATION, 0.0))
+    return max(base + per_mb * (instance_info.get("be/maxmem") or 0), 1.0)
+
+
+def estimate_evacuation(instances, concurrency, elapsed=None):
+    """Seconds until a set of migrations is done, `concurrency` at a time.
+
+    Migrations are handed, longest first, to whichever of the concurrent
+    slots frees up first.
+
+    @param instances: instance dicts still to migrate or migrating
+    @param elapsed: optional dict of instance name to the seconds its
+        migration has been running
+    @return: seconds, 0 if there's nothing left
+    """
+    if not instances:
+        return 0
+    elapsed = elapsed or {}
+    models = get_models(instance.get("disk_template")
+                        for instance in instances)
+    durations = sorted(
+        (max(estimate_duration(instance, models) -
+             elapsed.get(instance.get("name"), 0), 0)
+         for instance in instances), reverse=True)
+    slots = [0.0] * max(int(concurrency), 1)
+    for duration in durations:
+        slots[slots.index(min(slots))] += duration
+    return int(round(max(slots)))
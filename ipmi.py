@@ -12,7 +12,7 @@ def get_ipmi_info(node_name, cluster_name):
     ASSUME: (hardcoded) if fqdn begins with iRMC use IPMI_USER_FJ, else use IPMI_USER_HP
     ASSUME: iRMC fqdn starts with iRMC and iLO starts with ilo
     """
-    node_info = get_node_info(node_name, cluster_name)
+    node_info = get_node_info(node_name, cluster_name, fields=["tags"])
     node_tags = node_info["tags"]
     ipmi_info = {}
     for tag in node_tags:
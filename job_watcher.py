@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""
+Watch many Ganeti jobs at once from a single thread.
+
+Every watched job has one outstanding RAPI long-poll (WaitForJobChange)
+request and all of them are driven by one pycurl CurlMulti loop. Each state
+change is stored in a Redis hash (JOB_STATE_KEY) along with the job's last
+log lines, where migrate_instance_task reads it with read_job() instead of
+long-polling the job itself.
+
+Jobs are added with watch_job() from any process, the watcher picks them up
+from the WATCHED_JOBS_KEY sorted set, and while it runs it keeps
+WATCHER_HEARTBEAT_KEY alive. Jobs nobody watched for JOB_STATE_TTL seconds
+are dropped from the set. Run it next to the Celery workers with:
+
+    ./job_watcher.py
+"""
+import logging
+import time
+
+import pycurl
+
+from contrib.ganeti_client import GanetiApiError, JOB_STATUS_FINALIZED
+from ganeti_utils import cluster_connection
+from redis_clients import redis_client, dump_fields, load_fields
+
+# Sorted set of "<cluster>:<job_id>" members the watcher should track,
+# scored by the time they were added
+WATCHED_JOBS_KEY = "nodEvac:job_watcher:watched"
+# Hash with the last known state of a job
+JOB_STATE_KEY = "nodEvac:job_watcher:state:{cluster}:{job_id}"
+JOB_STATE_TTL = 86400
+# Set while a watcher runs, expires WATCHER_HEARTBEAT_TTL seconds after it
+# stopped
+WATCHER_HEARTBEAT_KEY = "nodEvac:job_watcher:heartbeat"
+WATCHER_HEARTBEAT_TTL = 30
+JOB_FIELDS = ["status", "opstatus", "start_ts", "end_ts"]
+# Job log lines kept in a job's state
+JOB_LOG_LINES = 20
+# Seconds before polling a job again after a failed request, doubled on
+# every failure in a row up to RETRY_MAX_DELAY
+RETRY_DELAY = 1
+RETRY_MAX_DELAY = 60
+
+
+def _member(cluster_name, job_id):
+    return "%s:%s" % (cluster_name, job_id)
+
+
+def watch_job(cluster_name, job_id):
+    """Ask the job watcher to track a Ganeti job."""
+    now = time.time()
+    pipe = redis_client('state').pipeline()
+    pipe.zadd(WATCHED_JOBS_KEY, now, _member(cluster_name, job_id))
+    # Jobs left behind while no watcher ran
+    pipe.zremrangebyscore(WATCHED_JOBS_KEY, 0, now - JOB_STATE_TTL)
+    pipe.execute()
+
+
+def read_job(cluster_name, job_id):
+    """
+    Return the state of a job as the watcher follows it: a dict of the
+    JOB_FIELDS and the job's last log lines ("log").
+
+    @return: the state, or None if it may be stale because no watcher
+        follows the job (none runs, it didn't pick the job up yet or it
+        gave up on it)
+    """
+    pipe = redis_client('state').pipeline(transaction=False)
+    pipe.exists(WATCHER_HEARTBEAT_KEY)
+    pipe.zscore(WATCHED_JOBS_KEY, _member(cluster_name, job_id))
+    pipe.hgetall(JOB_STATE_KEY.format(cluster=cluster_name, job_id=job_id))
+    watcher_alive, watched, job_state = pipe.execute()
+    job_state = load_fields(job_state)
+    if job_state is not None and job_state["status"] in JOB_STATUS_FINALIZED:
+        return job_state
+    if not watcher_alive or watched is None:
+        return None
+    return job_state
+
+
+class JobWatcher(object):
+    """Tracks Ganeti jobs over a single CurlMulti loop."""
+
+    def __init__(self, redis_conn=None):
+        self.redis_conn = redis_conn or redis_client('state')
+        self._multi = pycurl.CurlMulti()
+        # curl handle -> watch dict for every outstanding request
+        self._requests = {}
+        # watch dicts waiting to poll again after a failed request
+        self._delayed = []
+        # (cluster_name, job_id) pairs currently being watched
+        self._watched = set()
+
+    def __len__(self):
+        return len(self._watched)
+
+    def add(self, cluster_name, job_id):
+        """Start watching a job, unless it's already watched."""
+        job_id = str(job_id)
+        if (cluster_name, job_id) in self._watched:
+            return
+        self._watched.add((cluster_name, job_id))
+        self._send({
+            'cluster_name': cluster_name,
+            'job_id': job_id,
+            'job_info': None,
+            'log_serial': None,
+            'log': [],
+            'retry_delay': 0,
+        })
+
+    def _send(self, watch):
+        """Queue the next long-poll request for a watched job."""
+        cluster_conn = cluster_connection(watch['cluster_name'])
+        watch['request'] = cluster_conn.PrepareWaitForJobChange(
+            watch['job_id'], JOB_FIELDS, watch['job_info'],
+            watch['log_serial'])
+        curl = watch['request'][0]
+        self._requests[curl] = watch
+        self._multi.add_handle(curl)
+
+    def _send_later(self, watch):
+        """Poll a job again after a delay growing with every failure."""
+        watch['retry_delay'] = min(
+            max(watch['retry_delay'] * 2, RETRY_DELAY), RETRY_MAX_DELAY)
+        watch['retry_at'] = time.time() + watch['retry_delay']
+        self._delayed.append(watch)
+
+    def _send_delayed(self):
+        """Send the delayed polls that are due."""
+        now = time.time()
+        due = [watch for watch in self._delayed if watch['retry_at'] <= now]
+        for watch in due:
+            self._delayed.remove(watch)
+            self._send(watch)
+
+    def _forget(self, watch):
+        self._watched.discard((watch['cluster_name'], watch['job_id']))
+        self.redis_conn.zrem(WATCHED_JOBS_KEY, _member(
+            watch['cluster_name'], watch['job_id']))
+
+    def _complete(self, curl, curl_error):
+        """Handle a finished long-poll request."""
+        self._multi.remove_handle(curl)
+        watch = self._requests.pop(curl)
+        cluster_conn = cluster_connection(watch['cluster_name'])
+        try:
+            result = cluster_conn.FinishRequest(watch['request'],
+                                                curl_error=curl_error)
+        except GanetiApiError as rapi_error:
+            if rapi_error.code == 404:
+                logging.warning("Job %s on %s disappeared, not watching it",
+                                watch['job_id'], watch['cluster_name'])
+                self._forget(watch)
+                return
+            # Transient failure (e.g. master failover), poll again later
+            logging.warning("Watching job %s on %s failed: %s",
+                            watch['job_id'], watch['cluster_name'], rapi_error)
+            self._send_later(watch)
+            return
+
+        watch['retry_delay'] = 0
+        if result:
+            log_entries = result["log_entries"] or []
+            if log_entries:
+                watch['log_serial'] = max(entry[0] for entry in log_entries)
+            watch['job_info'] = result["job_info"]
+            job_info = dict(zip(JOB_FIELDS, result["job_info"]))
+            self._publish(watch, job_info, log_entries)
+            if job_info["status"] in JOB_STATUS_FINALIZED:
+                self._forget(watch)
+                return
+        self._send(watch)
+
+    def _publish(self, watch, job_info, log_entries):
+        """Store the new job state in redis."""
+        state_key = JOB_STATE_KEY.format(cluster=watch['cluster_name'],
+                                         job_id=watch['job_id'])
+        watch['log'].extend(entry[3] for entry in log_entries)
+        del watch['log'][:-JOB_LOG_LINES]
+        job_state = dict(job_info, log=watch['log'])
+        pipe = self.redis_conn.pipeline()
+        pipe.hmset(state_key, dump_fields(job_state))
+        pipe.expire(state_key, JOB_STATE_TTL)
+        pipe.execute()
+
+    def sync(self):
+        """Pick up jobs added with watch_job(), show the watcher is alive."""
+        pipe = self.redis_conn.pipeline()
+        pipe.set(WATCHER_HEARTBEAT_KEY, time.time(), ex=WATCHER_HEARTBEAT_TTL)
+        pipe.zremrangebyscore(WATCHED_JOBS_KEY, 0,
+                              time.time() - JOB_STATE_TTL)
+        pipe.zrange(WATCHED_JOBS_KEY, 0, -1)
+        for member in pipe.execute()[2]:
+            cluster_name, job_id = member.rsplit(':', 1)
+            self.add(cluster_name, job_id)
+
+    def run_once(self, timeout=1.0):
+        """Drive all outstanding transfers for up to timeout seconds."""
+        self._send_delayed()
+        if not self._requests:
+            time.sleep(timeout)
+            return
+        while True:
+            ret, _ = self._multi.perform()
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        while True:
+            queued, succeeded, failed = self._multi.info_read()
+            for curl in succeeded:
+                self._complete(curl, None)
+            for curl, errno, errmsg in failed:
+                self._complete(curl, (errno, errmsg))
+            if not queued:
+                break
+        self._multi.select(timeout)
+
+    def run_forever(self, timeout=1.0):
+        """Watch jobs until interrupted."""
+        while True:
+            self.sync()
+            self.run_once(timeout)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    JobWatcher().run_forever()
@@ -0,0 +1,102 @@
+"""
+Index of the evacuations and rolling maintenances, running and recent, kept
+in redis.
+
+Every job has a hash (JOB_KEY) with its type, cluster, nodes, state and
+start time, every field holding a JSON value. Jobs are indexed by start time
+in sorted sets: one of all jobs, one per cluster, per type and per cluster
+and type, and one of the jobs still running. Listing jobs reads a range of
+one index and the hashes it points to, instead of scanning the keyspace.
+Finished jobs are kept JOB_TTL seconds, and dropped from the indexes once
+they're older than that.
+"""
+import json
+import time
+
+from redis_clients import redis_client, dump_fields, read_hashes
+
+JOB_KEY = "nodEvac:job:{job_id}"
+JOBS_INDEX_KEY = "nodEvac:jobs"
+RUNNING_JOBS_KEY = JOBS_INDEX_KEY + ":running"
+# evacuation: evacuate_node_task, batch_evacuation: evacuate_nodes_task,
+# maintenance: rolling_maintenance_task
+JOB_TYPES = ('evacuation', 'batch_evacuation', 'maintenance')
+# Seconds a job is listed after it started
+JOB_TTL = 7 * 86400
+# Jobs per page of list_jobs()
+JOBS_PAGE_SIZE = 50
+
+redis_conn = redis_client('state')
+
+
+def _index_key(cluster_name=None, job_type=None):
+    index_key = JOBS_INDEX_KEY
+    if cluster_name is not None:
+        index_key += ":cluster:" + cluster_name
+    if job_type is not None:
+        index_key += ":type:" + job_type
+    return index_key
+
+
+def register_job(job_id, job_type, cluster_name, node_names):
+    """Add a job that just started to the index."""
+    started = time.time()
+    pipe = redis_conn.pipeline()
+    pipe.hmset(JOB_KEY.format(job_id=job_id), dump_fields({
+        'type': job_type, 'cluster_name': cluster_name,
+        'node_names': node_names, 'state': 'RUNNING', 'started': started}))
+    pipe.expire(JOB_KEY.format(job_id=job_id), JOB_TTL)
+    for index_key in (_index_key(), _index_key(cluster_name),
+                      _index_key(job_type=job_type),
+                      _index_key(cluster_name, job_type), RUNNING_JOBS_KEY):
+        pipe.zadd(index_key, started, job_id)
+    pipe.execute()
+
+
+def finish_job(job_id, state):
+    """Store the final state of a job, it's no longer listed as running."""
+    job_key = JOB_KEY.format(job_id=job_id)
+    pipe = redis_conn.pipeline()
+    pipe.zrem(RUNNING_JOBS_KEY, job_id)
+    pipe.exists(job_key)
+    if pipe.execute()[1]:
+        redis_conn.hset(job_key, 'state', json.dumps(state))
+
+
+def _read_jobs(index_key, start, stop):
+    """Read the jobs of a range of an index, newest first."""
+    pipe = redis_conn.pipeline()
+    pipe.zremrangebyscore(index_key, 0, time.time() - JOB_TTL)
+    pipe.zrevrange(index_key, start, stop)
+    job_ids = pipe.execute()[1]
+    jobs = []
+    for job_id, job in zip(job_ids, read_hashes(
+            redis_conn, [JOB_KEY.format(job_id=job_id)
+                         for job_id in job_ids])):
+        if job is None:
+            # Expired along with a record that outlived the index entry
+            redis_conn.zrem(index_key, job_id)
+            continue
+        job['job_id'] = job_id
+        jobs.append(job)
+    return jobs
+
+
+def running_jobs():
+    """Return the jobs still running, newest first."""
+    return _read_jobs(RUNNING_JOBS_KEY, 0, -1)
+
+
+def list_jobs(cluster_name=None, job_type=None, page=0,
+              page_size=JOBS_PAGE_SIZE):
+    """Return a page of the recent jobs, newest first.
+
+    @param cluster_name: only list the jobs of this cluster
+    @param job_type: only list jobs of this type, see JOB_TYPES
+    @return: (jobs, total), the jobs of the page and the number of jobs
+        matching the filters
+    """
+    index_key = _index_key(cluster_name, job_type)
+    jobs = _read_jobs(index_key, page * page_size,
+                      (page + 1) * page_size - 1)
+    return jobs, redis_conn.zcard(index_key)
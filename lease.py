@@ -0,0 +1,82 @@
+"""
+Leased locks kept in redis.
+
+A lease is a key holding the id of its owner (e.g. an evacuation or task id)
+that expires on its own, so a lock whose owner crashed frees itself. Owners
+that work longer than the TTL renew their lease as they make progress. Only
+the owner can renew or release a lease: both compare the key's value with
+the owner before touching it, in a single script.
+"""
+from redis_clients import redis_client
+
+redis_conn = redis_client('state')
+
+# Take every key or none: returns the owner of the first key already held
+_ACQUIRE_SCRIPT = redis_conn.register_script("""
+for _, key in ipairs(KEYS) do
+    local owner = redis.call('GET', key)
+    if owner then
+        return owner
+    end
+end
+for _, key in ipairs(KEYS) do
+    redis.call('SET', key, ARGV[1], 'EX', ARGV[2])
+end
+return false
+""")
+_RENEW_SCRIPT = redis_conn.register_script("""
+local renewed = 0
+for _, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[1] then
+        renewed = renewed + redis.call('EXPIRE', key, ARGV[2])
+    end
+end
+return renewed
+""")
+_RELEASE_SCRIPT = redis_conn.register_script("""
+local released = 0
+for _, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[1] then
+        released = released + redis.call('DEL', key)
+    end
+end
+return released
+""")
+
+
+def acquire_lease(key, owner, ttl):
+    """Take a lease for `ttl` seconds.
+
+    @return: None if it was taken, else the owner already holding it
+    """
+    if redis_conn.set(key, owner, nx=True, ex=ttl):
+        return None
+    running_owner = redis_conn.get(key)
+    if running_owner is None:
+        # Released in between
+        return acquire_lease(key, owner, ttl)
+    return running_owner
+
+
+def acquire_leases(keys, owner, ttl):
+    """Take several leases at once, either all of them or none.
+
+    @return: None if they were taken, else the owner of one already held
+    """
+    return _ACQUIRE_SCRIPT(keys=keys, args=[owner, ttl])
+
+
+def renew_leases(keys, owner, ttl):
+    """Extend the leases `owner` holds among keys to `ttl` seconds.
+
+    @return: the number of leases renewed
+    """
+    if not keys:
+        return 0
+    return _RENEW_SCRIPT(keys=keys, args=[owner, ttl])
+
+
+def release_leases(keys, owner):
+    """Free the leases `owner` holds among keys."""
+    if keys:
+        _RELEASE_SCRIPT(keys=keys, args=[owner])
@@ -0,0 +1,89 @@
+"""
+Rolling maintenance records kept in redis.
+
+A rolling maintenance walks a list of nodes through evacuation, shutdown and
+startup (see tasks.rolling_maintenance_task). Like evacuations, its state
+lives in a redis hash named after the id of the task running it, every field
+holding a JSON value:
+
+    cluster_name
+    node_names  the nodes to patch, in the order they're taken out
+    max_out     how many of them may be out of the cluster at once
+    state       M_RUNNING, M_HALTED (a node failed, no new node is taken
+                out), SUCCESS or FAILURE
+    nodes       node name to a dict with its phase, the id of the task
+                running that phase and, once it failed, a message
+
+A node's phase goes pending, evacuating, shutting_down, starting_up and
+finally done, or failed. A node is out of the cluster from the start of its
+evacuation until it's readded.
+"""
+import time
+
+from jobs import finish_job
+from progress import notify_progress
+from redis_clients import redis_client, dump_fields, load_fields
+
+MAINTENANCE_KEY = "nodEvac:maintenance:{maintenance_id}"
+# Seconds the record of a finished maintenance is kept
+MAINTENANCE_TTL = 7 * 86400
+# Nodes out of the cluster at once, by default
+MAX_NODES_OUT = 2
+# Phases of a node that's out of the cluster
+OUT_PHASES = ('evacuating', 'shutting_down', 'starting_up')
+
+redis_conn = redis_client('state')
+
+
+def update_maintenance(maintenance_id, **fields):
+    """Store the given fields of a maintenance record."""
+    fields["heartbeat"] = time.time()
+    redis_conn.hmset(MAINTENANCE_KEY.format(maintenance_id=maintenance_id),
+                     dump_fields(fields))
+    notify_progress(maintenance_id)
+
+
+def get_maintenance(maintenance_id):
+    """Return a maintenance record as a dict, or None."""
+    return load_fields(redis_conn.hgetall(
+        MAINTENANCE_KEY.format(maintenance_id=maintenance_id)))
+
+
+def end_maintenance(maintenance_id, state):
+    """Store the final state of a maintenance and let its record expire."""
+    update_maintenance(maintenance_id, state=state)
+    redis_conn.expire(MAINTENANCE_KEY.format(maintenance_id=maintenance_id),
+                      MAINTENANCE_TTL)
+    finish_job(maintenance_id, state)
+
+
+def nodes_out(nodes):
+    """Names of the nodes currently out of the cluster.
+
+    @param nodes: the nodes field of a maintenance record
+    """
+    return [name for name, node in nodes.items()
+            if node["phase"] in OUT_PHASES]
+
+
+def next_node(node_names, nodes, secondaries):
+    """Pick the next node to take out, or None.
+
+    Nodes are taken in order, but a node is skipped for now if it shares a
+    DRBD instance with a node that's out: whichever of the two is evacuated
+    couldn't migrate the instance to the other.
+
+    @param secondaries: node name to the secondary nodes of its primary
+        instances, for the pending nodes and the nodes out
+    """
+    out = set(nodes_out(nodes))
+    for node_name in node_names:
+        if nodes[node_name]["phase"] != 'pending':
+            continue
+        if out & set(secondaries.get(node_name, [])):
+            continue
+        if any(node_name in secondaries.get(out_node, [])
+               for out_node in out):
+            continue
+        return node_name
+    return None
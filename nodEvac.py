@@ -2,72 +2,107 @@
 """
 A Flask webapp that handles Ganeti Instance migrations as Celery Tasks
 """
-from flask import Flask, request, render_template, url_for, jsonify
-import redis
+from flask import Flask, Response, request, render_template, url_for,\
+        jsonify, json, abort, stream_with_context
+from celery.utils import uuid
+import time
 
 from ganeti_utils import get_node_info, get_cluster_info,\
-        GANETI_CLUSTER
+        get_node_instances, GANETI_CLUSTER
+from history import estimate_evacuation
+from planner import plan_batch_evacuation, plan_node_evacuation,\
+        ORDERING_POLICIES
+from evacuation import get_evacuation, is_stalled, lock_nodes,\
+        NODE_EVACUATION_KEY
+from jobs import running_jobs, list_jobs, JOB_TYPES, JOBS_PAGE_SIZE
+from lease import acquire_lease
+from maintenance import get_maintenance
+from progress import progress_changes
+from redis_clients import redis_client
 from tasks import celery_app, migrate_instance_task, evacuate_node_task,\
-        shutdown_node_task, startup_node_task
+        evacuate_nodes_task, shutdown_node_task, startup_node_task,\
+        rolling_maintenance_task,\
+        get_evacuation_status, get_migration_progress, EVACUATION_ENGINES,\
+        EVACUATION_CONCURRENCY,\
+        BATCH_CONCURRENCY, INSTANCE_MIGRATION_KEY, INSTANCE_MIGRATION_LOCK_TTL
 
 flask_app = Flask(__name__)
 
+# Seconds between keepalive comments on an idle status stream
+EVENTS_KEEPALIVE = 30
+
 @flask_app.route('/')
 def index():
     """ list all available clusters and search bar"""
-    running_evac_jobs = get_running_jobs()
+    running_evac_jobs = running_jobs()
     return render_template('index.html', ganeti_clusters=GANETI_CLUSTER.keys(),
                            running_evac_jobs=running_evac_jobs)
 
 @flask_app.route('/cluster/<cluster_name>')
 def ganeti_cluster_view(cluster_name):
     if cluster_name in GANETI_CLUSTER.keys():
-        cluster_info = get_cluster_info(cluster_name)
+        cluster_info = get_cluster_info(cluster_name, use_cache=True)
         return render_template('cluster.html', cluster_info=cluster_info)
 
 @flask_app.route('/jobs')
 def list_evacuate_jobs():
-    running_evac_jobs = get_running_jobs()
-    return render_template('jobs.html', running_evac_jobs=running_evac_jobs)
-
-def get_running_jobs():
     """
-    Get a list of currently running jobs from redis.
-
-    @return running_evac_jobs: list of dictionaries
+    Lists the running and recent jobs, newest first, a page at a time.
+    Optional filters: ?cluster_name=<cluster>&type=<job type>, see
+    jobs.JOB_TYPES.
     """
-    redis_conn = redis.StrictRedis()
-    running_evac_jobs = []
-    for running_evac_job  in redis_conn.scan_iter("nodEvac:evacuate_node:*"):
-        job_info = {}
-        _, _, cluster_name, node_name = running_evac_job.split(':')
-        job_info["node_name"] = node_name
-        job_info["cluster_name"] = cluster_name
-        running_evac_jobs.append(job_info)
-    return running_evac_jobs
+    cluster_name = request.args.get('cluster_name') or None
+    job_type = request.args.get('type') or None
+    if job_type is not None and job_type not in JOB_TYPES:
+        abort(400)
+    page = max(int(request.args.get('page', 0)), 0)
+    jobs, total = list_jobs(cluster_name, job_type, page)
+    for job in jobs:
+        job['started_at'] = time.strftime("%Y-%m-%d %H:%M",
+                                          time.localtime(job['started']))
+    return render_template('jobs.html', jobs=jobs, page=page,
+                           pages=(total + JOBS_PAGE_SIZE - 1) //
+                           JOBS_PAGE_SIZE,
+                           cluster_name=cluster_name, job_type=job_type,
+                           ganeti_clusters=GANETI_CLUSTER.keys(),
+                           job_types=JOB_TYPES)
 
 @flask_app.route('/<cluster_name>/<node_name>')
 def ganeti_node_view(node_name, cluster_name):
     """Ganeti Node view. Triggers evacuation tasks."""
-    node_info = get_node_info(node_name, cluster_name)
+    node_info = get_node_info(node_name, cluster_name, use_cache=True)
+    evacuation_eta = estimate_evacuation(
+        get_node_instances(node_name, cluster_name, use_cache=True),
+        EVACUATION_CONCURRENCY)
     return render_template('node.html',
                            node_name=node_name,
                            cluster_name=cluster_name,
-                           node_info=node_info)
+                           node_info=node_info,
+                           evacuation_eta=evacuation_eta,
+                           ordering_policies=ORDERING_POLICIES.keys())
 
 
 @flask_app.route('/migrate', methods=['POST'])
 def migrate_instance():
     """
-    Triggers a task for instance migration.
+    Triggers a task for instance migration, unless one is already running
+    for the instance.
     Return a JSON view with the URL get the task status.
     """
-    task = migrate_instance_task.apply_async(kwargs={
-        'instance_name': request.form['instance_name'],
-        'cluster_name': request.form['cluster_name']
-    })
+    lock_key = INSTANCE_MIGRATION_KEY.format(
+        cluster=request.form['cluster_name'],
+        instance=request.form['instance_name'])
+    task_id = uuid()
+    running_id = acquire_lease(lock_key, task_id, INSTANCE_MIGRATION_LOCK_TTL)
+    if running_id is not None:
+        task_id = running_id
+    else:
+        migrate_instance_task.apply_async(kwargs={
+            'instance_name': request.form['instance_name'],
+            'cluster_name': request.form['cluster_name']
+        }, task_id=task_id)
     return jsonify({}), 202, {
-        'Location': url_for('taskstatus', task_id=task.id)}
+        'Location': url_for('taskstatus', task_id=task_id)}
 
 @flask_app.route('/evacuate_node', methods=['POST'])
 def evacuate_node():
@@ -75,22 +110,135 @@ def evacuate_node():
     Triggers a task for node evacuation.
     Return a JSON view with the URL to get the task status.
     """
-    view_key = ('nodEvac:evacuate_node:' + request.form["cluster_name"] + ":"\
-            + request.form["node_name"])
-    redis_conn = redis.StrictRedis()
-    task_id = redis_conn.get(view_key)
-    # if empty there is no running task, so trigger one
-    if task_id == '' or task_id is None:
-        task = evacuate_node_task.apply_async(kwargs={
+    task_id = uuid()
+    running_id = lock_nodes(request.form["cluster_name"],
+                            [request.form["node_name"]], task_id)
+    if running_id is not None:
+        resume_if_stalled(running_id)
+        task_id = running_id
+    # the node is locked for the new evacuation, so trigger it
+    else:
+        evac_kwargs = {
             'node_name': request.form['node_name'],
             'cluster_name': request.form['cluster_name']
-        })
-        redis_conn.set(view_key, task.id)
-        task_id = task.id
-    # else return the running id
+        }
+        if request.form.get('concurrency'):
+            evac_kwargs['concurrency'] = int(request.form['concurrency'])
+        if request.form.get('engine') in EVACUATION_ENGINES:
+            evac_kwargs['engine'] = request.form['engine']
+        if request.form.get('order') in ORDERING_POLICIES:
+            evac_kwargs['order'] = request.form['order']
+        if request.form.get('target_node'):
+            evac_kwargs['target_node'] = request.form['target_node']
+        if request.form.get('iallocator'):
+            evac_kwargs['iallocator'] = request.form['iallocator']
+        evacuate_node_task.apply_async(kwargs=evac_kwargs, task_id=task_id)
     return jsonify({}), 202, {
         'Location': url_for('evacjob_taskstatus', task_id=task_id)}
 
+@flask_app.route('/evacuation_plan/<cluster_name>/<node_name>')
+def evacuation_plan(node_name, cluster_name):
+    """
+    Dry run of a node evacuation: where every instance would go, whether the
+    remaining nodes have the memory for them, and how long it should take,
+    for the same concurrency, order, target_node and iallocator arguments as
+    evacuate_node. Nothing is changed on the cluster.
+    Return a JSON view with the plan (see planner.plan_node_evacuation)
+    and its eta in seconds.
+    """
+    concurrency = int(request.args.get('concurrency',
+                                       EVACUATION_CONCURRENCY))
+    order = request.args.get('order')
+    if order not in ORDERING_POLICIES:
+        order = 'default'
+    plan = plan_node_evacuation(
+        node_name, cluster_name, order,
+        target_node=request.args.get('target_node') or None,
+        iallocator=request.args.get('iallocator') or None)
+    return jsonify(with_eta(plan, concurrency))
+
+def with_eta(plan, concurrency):
+    """Add the estimated duration of an evacuation plan to it."""
+    plan['eta'] = estimate_evacuation(plan['migrations'], concurrency)
+    return plan
+
+def resume_if_stalled(evacuation_id):
+    """
+    Run an evacuation's task again under the same id if nothing worked on
+    the evacuation for a while (its worker probably died), so it resumes
+    from its checkpoints.
+    """
+    evacuation = get_evacuation(evacuation_id)
+    if evacuation is None or not is_stalled(evacuation):
+        return
+    if evacuation.get("node_names"):
+        evacuation_task = evacuate_nodes_task
+    else:
+        evacuation_task = evacuate_node_task
+    evacuation_task.apply_async(kwargs=evacuation["options"],
+                                task_id=evacuation_id)
+
+@flask_app.route('/evacuate_nodes', methods=['POST'])
+def evacuate_nodes():
+    """
+    Plans, and unless dry_run is set triggers, the evacuation of a set of
+    nodes (node_name given once per node, or comma separated).
+    Return a JSON view with the placement plan for a dry run, or with the
+    URL to get the task status.
+    """
+    cluster_name = request.form['cluster_name']
+    node_names = form_node_names()
+    if request.form.get('dry_run'):
+        concurrency = int(request.form.get('concurrency') or
+                          BATCH_CONCURRENCY)
+        return jsonify(with_eta(plan_batch_evacuation(node_names,
+                                                      cluster_name),
+                                concurrency))
+
+    task_id = uuid()
+    running_id = lock_nodes(cluster_name, node_names, task_id)
+    if running_id is not None:
+        # Some of the nodes are already being evacuated
+        resume_if_stalled(running_id)
+        return jsonify({'running_evacuation': running_id}), 409, {
+            'Location': url_for('evacjob_taskstatus', task_id=running_id)}
+    evac_kwargs = {'node_names': node_names, 'cluster_name': cluster_name}
+    if request.form.get('concurrency'):
+        evac_kwargs['concurrency'] = int(request.form['concurrency'])
+    evacuate_nodes_task.apply_async(kwargs=evac_kwargs, task_id=task_id)
+    return jsonify({}), 202, {
+        'Location': url_for('evacjob_taskstatus', task_id=task_id)}
+
+def form_node_names():
+    """Node names posted as node_name, given once per node or comma
+    separated."""
+    return split_names(request.form.getlist('node_name'))
+
+def split_names(values):
+    """Names from a list of form values, each a name or comma separated."""
+    names = []
+    for value in values:
+        names.extend(name.strip() for name in value.split(',')
+                     if name.strip())
+    return names
+
+@flask_app.route('/rolling_maintenance', methods=['POST'])
+def rolling_maintenance():
+    """
+    Triggers the rolling maintenance (evacuation, shutdown and startup) of
+    a list of nodes (node_name given once per node, or comma separated, in
+    the order they are taken out). max_out caps the nodes out of the
+    cluster at once.
+    Return a JSON view with the URL to get the maintenance status.
+    """
+    maintenance_kwargs = {'node_names': form_node_names(),
+                          'cluster_name': request.form['cluster_name']}
+    if request.form.get('max_out'):
+        maintenance_kwargs['max_out'] = int(request.form['max_out'])
+    task = rolling_maintenance_task.apply_async(kwargs=maintenance_kwargs)
+    return jsonify({}), 202, {
+        'Location': url_for('maintenance_status', task_id=task.id)}
+
 @flask_app.route('/shutdown_node', methods=['POST'])
 def shutdown_node():
     """
@@ -125,6 +273,9 @@ def taskstatus(task_id):
     Parses the status for th Celery job requested and returns a JSON view with
     relevant info.
     """
+    return jsonify(migration_status(task_id))
+
+def migration_status(task_id):
     task = migrate_instance_task.AsyncResult(task_id)
     if task.state == 'PENDING':
         response = {
@@ -141,6 +292,7 @@ def taskstatus(task_id):
             'job_id': task.info.get('job_id', ''),
             'job_status': task.info.get('job_status', ''),
             'job_details': task.info.get('job_details', ''),
+            'job_log': task.info.get('job_log', []),
         }
         if 'result' in task.info:
             response['result'] = task.info['result']
@@ -152,17 +304,85 @@ def taskstatus(task_id):
             'total': 1,
             'status': str(task.info),  # this is the exception raised
         }
-    return jsonify(response)
+    return response
+
+@flask_app.route('/statuses')
+def task_statuses():
+    """
+    Returns a JSON view with the progress of many migrations at once: the
+    migrate tasks given as task_id (once per task, or comma separated), or
+    those of a node's instances (cluster_name and node_name), then also
+    mapping every instance to its task.
+    Every task is read from the result backend in a single round-trip.
+    """
+    instance_tasks = {}
+    if request.args.get('node_name'):
+        instance_tasks = node_migration_tasks(request.args['node_name'],
+                                              request.args['cluster_name'])
+        task_ids = instance_tasks.values()
+    else:
+        task_ids = split_names(request.args.getlist('task_id'))
+    return jsonify({'tasks': get_migration_progress(task_ids),
+                    'instances': instance_tasks})
+
+def node_migration_tasks(node_name, cluster_name):
+    """
+    Find the migrate tasks of a node's instances: those of the evacuation
+    running on the node and those migrating an instance on its own.
+
+    @return: dict of instance name to task id
+    """
+    instance_names = get_node_info(node_name, cluster_name,
+                                   use_cache=True).get("pinst_list") or []
+    task_ids = redis_client('state').mget(
+        [NODE_EVACUATION_KEY.format(cluster=cluster_name, node=node_name)] +
+        [INSTANCE_MIGRATION_KEY.format(cluster=cluster_name, instance=name)
+         for name in instance_names])
+    evacuation_id = task_ids.pop(0)
+    instance_tasks = dict((name, task_id) for name, task_id
+                          in zip(instance_names, task_ids) if task_id)
+    evacuation = evacuation_id and get_evacuation(evacuation_id)
+    if evacuation:
+        instance_tasks.update(evacuation.get("tasks") or {})
+    return instance_tasks
 
 @flask_app.route('/evac_status/<task_id>')
 def evacjob_taskstatus(task_id):
     """
-    Parses the status for a evacuate_node_task Celery job requested and
-    returns a JSON view with relevant info.
+    Parses the status of the evacuation started by the evacuate_node_task
+    Celery job requested and returns a JSON view with relevant info.
+    With ?since=<version>, the progress only lists the migrations that
+    changed after that version of a previous status.
     """
-    task = evacuate_node_task.AsyncResult(task_id)
-    result = {'result': task.state, 'message': task.info}
-    return jsonify(result)
+    return jsonify(evacuation_status(task_id,
+                                     int(request.args.get('since', 0))))
+
+def evacuation_status(task_id, since=0):
+    evacuation = get_evacuation_status(task_id, since)
+    if evacuation is None:
+        # The task hasn't started yet, or failed before recording anything
+        task = evacuate_node_task.AsyncResult(task_id)
+        result = {'result': task.state, 'message': str(task.info)}
+    else:
+        result = {'result': evacuation.pop('state'), 'message': evacuation}
+    return result
+
+@flask_app.route('/maintenance_status/<task_id>')
+def maintenance_status(task_id):
+    """
+    Returns a JSON view with the state of a rolling maintenance and the
+    phase of each of its nodes.
+    """
+    return jsonify(rolling_maintenance_status(task_id))
+
+def rolling_maintenance_status(task_id):
+    maintenance = get_maintenance(task_id)
+    if maintenance is None:
+        task = rolling_maintenance_task.AsyncResult(task_id)
+        result = {'result': task.state, 'message': str(task.info)}
+    else:
+        result = {'result': maintenance.pop('state'), 'message': maintenance}
+    return result
 
 @flask_app.route('/shut_status/<task_id>')
 def shutdownjob_taskstatus(task_id):
@@ -170,9 +390,11 @@ def shutdownjob_taskstatus(task_id):
     Parses the status for a shutdown_node_task Celery job requested and
     returns a JSON view with relevant info.
     """
+    return jsonify(shutdown_status(task_id))
+
+def shutdown_status(task_id):
     task = shutdown_node_task.AsyncResult(task_id)
-    result = {'result': task.state, 'message': task.info}
-    return jsonify(result)
+    return {'result': task.state, 'message': task.info}
 
 
 @flask_app.route('/start_status/<task_id>')
@@ -181,9 +403,56 @@ def startup_taskstatus(task_id):
     Parses the status for a startup_node_task Celery job requested and returns
     a JSON view with  relevant info.
     """
+    return jsonify(startup_status(task_id))
+
+def startup_status(task_id):
     task = startup_node_task.AsyncResult(task_id)
-    result = {'result': task.state, 'message': task.info}
-    return jsonify(result)
+    return {'result': task.state, 'message': task.info}
+
+# Status views that can be streamed from /events, with the function reading
+# their status, the field holding its state and whether the status is
+# versioned (the reader takes a since version, see evacuation_status)
+STATUS_STREAMS = {
+    'status': (migration_status, 'state', False),
+    'evac_status': (evacuation_status, 'result', True),
+    'maintenance_status': (rolling_maintenance_status, 'result', False),
+    'shut_status': (shutdown_status, 'result', False),
+    'start_status': (startup_status, 'result', False),
+}
+
+@flask_app.route('/events/<status_view>/<task_id>')
+def status_events(status_view, task_id):
+    """
+    Streams the status of a task as Server-Sent Events: the JSON of
+    /<status_view>/<task_id>, sent once and then on every change the tasks
+    publish (see progress.py), until the task is done. Versioned statuses
+    are sent whole once, then only with what changed since the last event.
+    """
+    if status_view not in STATUS_STREAMS:
+        abort(404)
+    read_status, state_field, versioned = STATUS_STREAMS[status_view]
+
+    def stream():
+        since = 0
+        for changed in progress_changes(task_id, EVENTS_KEEPALIVE):
+            if not changed:
+                yield ": keepalive\n\n"
+                continue
+            if versioned:
+                status = read_status(task_id, since)
+                if isinstance(status['message'], dict):
+                    since = status['message'].get('version', since)
+            else:
+                status = read_status(task_id)
+            yield "data: " + json.dumps(status) + "\n\n"
+            if status[state_field] in ('SUCCESS', 'FAILURE'):
+                return
+
+    return Response(stream_with_context(stream()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
 
 if __name__ == '__main__':
-    flask_app.run(host='::')
+    # Threaded, every open status stream holds a thread
+    flask_app.run(host='::', threaded=True)
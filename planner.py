@@ -0,0 +1,303 @@
+"""
+Evacuation planning: in which order instances leave a node, and where they
+land.
+"""
+from ganeti_utils import get_node_instances, query_resource,\
+    INSTANCE_INFO_FIELDS
+from throttle import inbound_migrations
+
+# Instances tagged evac_priority:<n> are migrated highest n first by the
+# tag_priority policy, untagged instances count as 0
+PRIORITY_TAG_PREFIX = "evac_priority:"
+
+
+def instance_memory(instance):
+    return instance.get("be/maxmem") or 0
+
+
+def instance_priority(instance):
+    for tag in instance.get("tags") or []:
+        if tag.startswith(PRIORITY_TAG_PREFIX):
+            try:
+                return int(tag[len(PRIORITY_TAG_PREFIX):])
+            except ValueError:
+                pass
+    return 0
+
+
+# Disk templates whose instances migrate to their DRBD secondary
+INTERNALLY_MIRRORED_TEMPLATES = frozenset(["drbd"])
+# Disk templates whose instances may migrate to any node of their group
+EXTERNALLY_MIRRORED_TEMPLATES = frozenset(["sharedfile", "blockdev", "rbd",
+                                           "ext", "gluster"])
+TARGET_NODE_FIELDS = ["name", "group", "mfree", "offline", "drained",
+                      "vm_capable"]
+BATCH_NODE_FIELDS = TARGET_NODE_FIELDS + ["dfree"]
+BATCH_INSTANCE_FIELDS = INSTANCE_INFO_FIELDS + ["disk.sizes"]
+
+# Sort keys for every ordering policy, None keeps Ganeti's order
+ORDERING_POLICIES = {
+    # Drain the instance count quickly
+    'smallest_memory_first': instance_memory,
+    # Start the long pole early
+    'largest_memory_first': lambda instance: -instance_memory(instance),
+    'tag_priority': lambda instance: -instance_priority(instance),
+    'default': None,
+}
+
+
+def order_instances(instances, policy='default'):
+    """Sort instance dicts (see INSTANCE_INFO_FIELDS) by an ordering policy.
+
+    The sort is stable, instances that compare equal keep their order.
+    """
+    sort_key = ORDERING_POLICIES[policy]
+    if sort_key is None:
+        return list(instances)
+    return sorted(instances, key=sort_key)
+
+
+def get_migration_details(node_name, cluster_name):
+    """Fetch the primary instances of a node with a single query.
+
+    @return: dict of instance name to instance dict
+    """
+    return dict((instance["name"], instance) for instance in
+                get_node_instances(node_name, cluster_name))
+
+
+def plan_migration_order(instance_names, details, policy='default'):
+    """Order the instances to migrate off a node.
+
+    Instances missing from details are migrated last, in the given order.
+
+    @param instance_names: the node's primary instances, e.g. its pinst_list
+    @param details: result of get_migration_details()
+    @return: list of instance names
+    """
+    if ORDERING_POLICIES[policy] is None:
+        return list(instance_names)
+    known = [details[name] for name in instance_names if name in details]
+    unknown = [name for name in instance_names if name not in details]
+    return [instance["name"] for instance in
+            order_instances(known, policy)] + unknown
+
+
+def migration_target(instance, target_node=None):
+    """Return the node a migration lands on, if it's already decided.
+
+    DRBD instances always move to their secondary. Externally mirrored
+    instances move to target_node when one is given. For everything else the
+    target is None: it's either chosen with choose_targets() or by Ganeti.
+    """
+    disk_template = instance.get("disk_template")
+    if disk_template in INTERNALLY_MIRRORED_TEMPLATES:
+        return (instance.get("snodes") or [None])[0]
+    if disk_template in EXTERNALLY_MIRRORED_TEMPLATES:
+        return target_node
+    return None
+
+
+def get_target_candidates(node_name, cluster_name):
+    """Nodes that may receive the externally mirrored instances of a node.
+
+    These are the online, undrained, vm_capable nodes of its node group.
+
+    @return: dict of node name to node dict (see TARGET_NODE_FIELDS)
+    """
+    nodes = query_resource(cluster_name, "node", TARGET_NODE_FIELDS)
+    groups = [node["group"] for node in nodes if node["name"] == node_name]
+    return dict((node["name"], node) for node in nodes
+                if node["group"] in groups and node["name"] != node_name and
+                node["vm_capable"] and not node["offline"] and
+                not node["drained"])
+
+
+def choose_targets(instance, candidates, cluster_name):
+    """Rank the candidates an instance could migrate to.
+
+    Only nodes with enough free memory for the instance qualify. Nodes
+    receiving fewer migrations come first, then nodes with more free memory.
+
+    @param candidates: result of get_target_candidates()
+    @return: list of node names, best first
+    """
+    fitting = [name for name, node in candidates.items()
+               if (node["mfree"] or 0) >= instance_memory(instance)]
+    inbound = inbound_migrations(cluster_name, fitting)
+    return sorted(fitting, key=lambda name: (inbound[name],
+                                             -candidates[name]["mfree"]))
+
+
+def instance_disk(instance):
+    return sum(instance.get("disk.sizes") or [])
+
+
+def _place(instance, group_targets):
+    """Pick the target with the most free memory that fits an instance.
+
+    Only nodes with room for its memory (and for its disks, if it gets a new
+    DRBD secondary) qualify.
+
+    @param group_targets: the target node dicts of the instance's node group
+    """
+    needs_disk = instance["disk_template"] in INTERNALLY_MIRRORED_TEMPLATES
+    fitting = [node for node in group_targets
+               if (node["mfree"] or 0) >= instance_memory(instance) and
+               (not needs_disk or
+                (node["dfree"] or 0) >= instance_disk(instance))]
+    if not fitting:
+        return None
+    return max(fitting, key=lambda node: node["mfree"])["name"]
+
+
+def plan_batch_evacuation(node_names, cluster_name):
+    """Place every primary instance of a set of nodes outside of the set.
+
+    Instances are placed largest first, each on the node of its group with
+    the most free memory left, so nothing lands on a node that's evacuated
+    next. DRBD instances move to their secondary, unless that's in the set
+    too: then the secondary is first moved to the chosen node.
+
+    @return: dict with
+        - migrations: instance dicts in placement order, with their target
+          and new_secondary (None unless it changes)
+        - unmovable: name, pnode and reason of the instances that can't be
+          moved
+        - degraded: DRBD instances staying up whose secondary is in the set
+        - capacity: for every node receiving instances, its free memory and
+          disk now (mfree, dfree) and once the plan is done (mfree_left,
+          dfree_left)
+    """
+    evacuated = set(node_names)
+    nodes = query_resource(cluster_name, "node", BATCH_NODE_FIELDS)
+    node_groups = dict((node["name"], node["group"]) for node in nodes)
+    targets = dict((node["name"], dict(node)) for node in nodes
+                   if node["name"] not in evacuated and
+                   node["vm_capable"] and not node["offline"] and
+                   not node["drained"])
+    # Placement only ever looks at the nodes of one group
+    group_targets = {}
+    for node in targets.values():
+        group_targets.setdefault(node["group"], []).append(node)
+    instances = query_resource(
+        cluster_name, "instance", BATCH_INSTANCE_FIELDS,
+        ["|"] + [["=", "pnode", node] for node in node_names] +
+        [["=[]", "snodes", node] for node in node_names])
+
+    plan = {'migrations': [], 'unmovable': [], 'degraded': [], 'capacity': {}}
+
+    def unmovable(instance, reason):
+        plan['unmovable'].append({'name': instance["name"],
+                                  'pnode': instance["pnode"],
+                                  'reason': reason})
+
+    for instance in sorted(instances, key=instance_memory, reverse=True):
+        if instance["pnode"] not in evacuated:
+            plan['degraded'].append(instance["name"])
+            continue
+        instance = dict(instance, group=node_groups.get(instance["pnode"]),
+                        new_secondary=None)
+        disk_template = instance["disk_template"]
+        secondary = (instance["snodes"] or [None])[0]
+        if disk_template in INTERNALLY_MIRRORED_TEMPLATES:
+            if secondary in targets:
+                target = secondary
+                free_memory = targets[target]["mfree"] or 0
+                if free_memory < instance_memory(instance):
+                    unmovable(instance,
+                              "not enough memory on secondary " + target)
+                    continue
+            else:
+                target = _place(instance,
+                                group_targets.get(instance["group"], []))
+                instance["new_secondary"] = target
+                if target is not None:
+                    targets[target]["dfree"] -= instance_disk(instance)
+        elif disk_template in EXTERNALLY_MIRRORED_TEMPLATES:
+            target = _place(instance, group_targets.get(instance["group"], []))
+        else:
+            unmovable(instance,
+                      "disk template %s can't be migrated" % disk_template)
+            continue
+        if target is None:
+            unmovable(instance, "no node has room for it")
+            continue
+        targets[target]["mfree"] -= instance_memory(instance)
+        instance["target"] = target
+        plan['migrations'].append(instance)
+
+    for node in nodes:
+        if node["name"] in targets and node != targets[node["name"]]:
+            target = targets[node["name"]]
+            plan['capacity'][node["name"]] = {
+                'mfree': node["mfree"], 'dfree': node["dfree"],
+                'mfree_left': target["mfree"], 'dfree_left': target["dfree"]}
+    return plan
+
+
+def plan_node_evacuation(node_name, cluster_name, order='default',
+                         target_node=None, iallocator=None):
+    """Plan the evacuation of one node the way evacuate_node_task runs it.
+
+    Instances keep the migration order of the `order` policy and land where
+    migrate_instance_task would send them (see migration_target()): DRBD
+    instances on their secondary, externally mirrored instances on
+    target_node, on iallocator's choice (target None) or on the node
+    choose_targets() ranks first. Disks never move. Each placement takes its
+    memory off the node for the next ones.
+
+    @return: dict with migrations, unmovable, degraded and capacity (memory
+        only), see plan_batch_evacuation()
+    """
+    candidates = dict((name, dict(node)) for name, node in
+                      get_target_candidates(node_name, cluster_name).items())
+    instances = query_resource(cluster_name, "instance",
+                               INSTANCE_INFO_FIELDS,
+                               ["|", ["=", "pnode", node_name],
+                                ["=[]", "snodes", node_name]])
+    details = dict((instance["name"], instance) for instance in instances
+                   if instance["pnode"] == node_name)
+
+    plan = {'migrations': [], 'unmovable': [], 'capacity': {},
+            'degraded': sorted(instance["name"] for instance in instances
+                               if instance["pnode"] != node_name)}
+
+    def unmovable(instance, reason):
+        plan['unmovable'].append({'name': instance["name"],
+                                  'pnode': instance["pnode"],
+                                  'reason': reason})
+
+    for instance_name in plan_migration_order(sorted(details), details,
+                                              order):
+        instance = dict(details[instance_name], new_secondary=None)
+        disk_template = instance["disk_template"]
+        target = migration_target(instance, target_node)
+        if disk_template in INTERNALLY_MIRRORED_TEMPLATES:
+            if target not in candidates:
+                unmovable(instance, "secondary %s can't receive it" % target)
+                continue
+            if (candidates[target]["mfree"] or 0) < instance_memory(instance):
+                unmovable(instance,
+                          "not enough memory on secondary " + target)
+                continue
+        elif disk_template in EXTERNALLY_MIRRORED_TEMPLATES:
+            if target is None and iallocator is None:
+                target = (choose_targets(instance, candidates, cluster_name) or
+                          [None])[0]
+                if target is None:
+                    unmovable(instance, "no node has room for it")
+                    continue
+        else:
+            unmovable(instance,
+                      "disk template %s can't be migrated" % disk_template)
+            continue
+        if target in candidates:
+            node = candidates[target]
+            capacity = plan['capacity'].setdefault(target, {
+                'mfree': node["mfree"], 'mfree_left': node["mfree"]})
+            node["mfree"] = (node["mfree"] or 0) - instance_memory(instance)
+            capacity['mfree_left'] = node["mfree"]
+        instance["target"] = target
+        plan['migrations'].append(instance)
+    return plan
@@ -0,0 +1,47 @@
+"""
+Progress notifications for the status streams of the web views.
+
+Whenever the progress of a task or of an evacuation or maintenance record
+changes, its id is published on its PROGRESS_CHANNEL. The /events views
+(see nodEvac.py) wait on that channel and only read the status again when
+something was published, instead of every browser polling for it.
+"""
+from redis_clients import redis_client
+
+PROGRESS_CHANNEL = "nodEvac:progress:{task_id}"
+
+redis_conn = redis_client('state')
+
+
+def notify_progress(*task_ids):
+    """Announce that the progress of the given tasks or records changed.
+
+    Ids that are None are skipped.
+    """
+    pipe = redis_conn.pipeline(transaction=False)
+    for task_id in task_ids:
+        if task_id is not None:
+            pipe.publish(PROGRESS_CHANNEL.format(task_id=task_id), task_id)
+    pipe.execute()
+
+
+def progress_changes(task_id, keepalive):
+    """Wait for the progress of a task or record to change.
+
+    A generator: yields True right away (the status should be read once),
+    then True after every change, or False after keepalive seconds without
+    any. Changes published in a burst are coalesced into one.
+    """
+    pubsub = redis_conn.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(PROGRESS_CHANNEL.format(task_id=task_id))
+    try:
+        yield True
+        while True:
+            if pubsub.get_message(timeout=keepalive) is None:
+                yield False
+                continue
+            while pubsub.get_message() is not None:
+                pass
+            yield True
+    finally:
+        pubsub.close()
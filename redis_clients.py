@@ -0,0 +1,80 @@
+"""
+Redis clients shared by the web app and the workers.
+
+Each kind of data nodEvac keeps in redis has its own client, created on
+first use and kept for the lifetime of the process, so every request and
+task reuses the connections of its pool instead of connecting again.
+redis-py pools notice a fork and reconnect in the child (e.g. a prefork
+Celery worker).
+
+Where each kind lives comes from the optional REDIS_URLS dict in
+cluster_config.py (see ganeti_utils.py), so results, state and caches can
+go to separate databases or instances. Kinds missing from it use
+DEFAULT_REDIS_URL:
+
+    REDIS_URLS = {
+        "broker": "redis+socket:///var/run/redis/redis.sock",
+        "results": "redis+socket:///var/run/redis/redis.sock",
+        "state": "unix:///var/run/redis/redis.sock?db=1",
+        "cache": "redis://cache.example.com:6379/0",
+    }
+
+    broker   the Celery broker, a Celery URL
+    results  Celery task results, a Celery URL
+    state    evacuation and maintenance records, leases, migration slots,
+             the job index, progress notifications, Ganeti job states and
+             the migration history
+    cache    cached Ganeti reads and cluster snapshots
+
+Keys read or written together, e.g. by one script or transaction, are
+always of the same kind.
+"""
+import json
+
+import redis
+
+try:
+    from cluster_config import REDIS_URLS
+except ImportError:
+    REDIS_URLS = {}
+
+DEFAULT_REDIS_URL = "redis://localhost:6379/0"
+REDIS_KINDS = ('broker', 'results', 'state', 'cache')
+
+_CLIENTS = {}
+
+
+def redis_url(kind):
+    """Return the URL of the redis holding a kind of data."""
+    return REDIS_URLS.get(kind, DEFAULT_REDIS_URL)
+
+
+def redis_client(kind):
+    """Return the shared client of the redis holding a kind of data."""
+    if kind not in _CLIENTS:
+        _CLIENTS[kind] = redis.StrictRedis.from_url(redis_url(kind))
+    return _CLIENTS[kind]
+
+
+def dump_fields(fields):
+    """Encode a dict as the fields of a hash, every value as JSON."""
+    return dict((field, json.dumps(value)) for field, value in fields.items())
+
+
+def load_fields(fields):
+    """Decode the fields of a hash written by dump_fields(), or None."""
+    if not fields:
+        return None
+    return dict((field, json.loads(value)) for field, value in fields.items())
+
+
+def read_hashes(redis_conn, keys):
+    """
+    Read many hashes written by dump_fields() in a single round-trip.
+
+    @return: list of dicts, None for missing keys
+    """
+    pipe = redis_conn.pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(key)
+    return [load_fields(fields) for fields in pipe.execute()]
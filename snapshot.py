@@ -0,0 +1,246 @@
+"""
+Cluster inventory snapshots kept in redis.
+
+sync_cluster() stores every node, instance and node group of a cluster in
+redis, so views and planners can read the inventory without talking to the
+master. Syncs are incremental: a cheap query lists each object's serial_no
+and only objects whose serial_no changed are fetched in full. Node memory and
+disk figures are live data without a serial, so they are refreshed on every
+sync with the listing query, and the per-node instance lists are derived
+from the instance snapshot.
+"""
+import json
+import time
+import uuid
+
+import cache
+# Module import, ganeti_utils imports this module in turn
+import ganeti_utils
+from lease import acquire_lease, renew_leases, release_leases
+from redis_clients import redis_client
+
+SNAPSHOT_KEY = "nodEvac:snapshot:{cluster}:{kind}"
+SNAPSHOT_SERIALS_KEY = "nodEvac:snapshot:{cluster}:{kind}:serials"
+SNAPSHOT_META_KEY = "nodEvac:snapshot:{cluster}:meta"
+# Lease of the running sync of a cluster (see lease.py), in the state redis
+SNAPSHOT_LOCK_KEY = "nodEvac:snapshot:{cluster}:lock"
+# Set when a sync was asked for while another one ran, see sync_cluster()
+SNAPSHOT_PENDING_KEY = "nodEvac:snapshot:{cluster}:pending"
+
+# Seconds between syncs, and age after which readers ignore a snapshot
+SNAPSHOT_INTERVAL = 30
+SNAPSHOT_MAX_AGE = 3 * SNAPSHOT_INTERVAL
+# Seconds the lock of a sync lasts, it's renewed after every step
+SNAPSHOT_LOCK_TTL = SNAPSHOT_INTERVAL
+
+# Fields listed on every sync, the first two must be name and serial_no
+LIST_FIELDS = {
+    'node': ["name", "serial_no", "mtotal", "mfree", "dtotal", "dfree"],
+    'instance': ["name", "serial_no"],
+    'group': ["name", "serial_no"],
+}
+# Fields fetched only for objects that changed
+CONFIG_FIELDS = {
+    'node': ["name", "serial_no", "mtime", "role", "tags", "group",
+             "offline", "drained", "master_candidate", "vm_capable"],
+    'instance': ["name", "serial_no", "mtime", "pnode", "snodes",
+                 "admin_state", "disk_template", "be/maxmem", "be/minmem",
+                 "be/vcpus", "disk.sizes", "tags"],
+    'group': ["name", "serial_no", "mtime", "uuid", "node_list",
+              "alloc_policy", "tags"],
+}
+# Cluster-wide info kept in the snapshot meta hash
+CLUSTER_INFO_FIELDS = ["name", "software_version", "enabled_disk_templates",
+                       "enabled_hypervisors", "tags", "master"]
+
+redis_conn = redis_client('cache')
+
+
+def _name_filter(names):
+    return ["|"] + [["=", "name", name] for name in names]
+
+
+def _sync_kind(cluster, kind):
+    """Bring one object type of the snapshot up to date.
+
+    @return: (dict of object name to its listing row, number of objects
+        added, changed or removed)
+    """
+    snapshot_key = SNAPSHOT_KEY.format(cluster=cluster, kind=kind)
+    serials_key = SNAPSHOT_SERIALS_KEY.format(cluster=cluster, kind=kind)
+    listing = dict((row["name"], row) for row in ganeti_utils.query_resource(
+        cluster, kind, LIST_FIELDS[kind]))
+    known_serials = redis_conn.hgetall(serials_key)
+
+    changed = [name for name, row in listing.items()
+               if known_serials.get(name) != str(row["serial_no"])]
+    removed = [name for name in known_serials if name not in listing]
+
+    pipe = redis_conn.pipeline()
+    if changed:
+        for obj in ganeti_utils.query_resource(cluster, kind,
+                                               CONFIG_FIELDS[kind],
+                                               _name_filter(changed)):
+            pipe.hset(snapshot_key, obj["name"], json.dumps(obj))
+            pipe.hset(serials_key, obj["name"], obj["serial_no"])
+    if removed:
+        pipe.hdel(snapshot_key, *removed)
+        pipe.hdel(serials_key, *removed)
+    pipe.execute()
+    return listing, len(changed) + len(removed)
+
+
+def sync_cluster(cluster):
+    """Update the snapshot of a cluster, fetching only what changed.
+
+    A sync asked for while another one of the same cluster runs, e.g. right
+    after a job changed the cluster, may come after the running one read
+    the cluster: it's left to the running one, which syncs again once done.
+    The running sync holds a lease on the cluster, renewed after every step,
+    and stops if it lost it.
+
+    @return: dict with the number of changed objects, or None if another
+        sync of the same cluster is already running, or took over
+    """
+    lock_key = SNAPSHOT_LOCK_KEY.format(cluster=cluster)
+    pending_key = SNAPSHOT_PENDING_KEY.format(cluster=cluster)
+    owner = uuid.uuid4().hex
+    if acquire_lease(lock_key, owner, SNAPSHOT_LOCK_TTL) is not None:
+        redis_conn.set(pending_key, 1, ex=SNAPSHOT_INTERVAL)
+        return None
+
+    def keep_lock():
+        """Whether the sync still holds the lock, renewing it."""
+        return renew_leases([lock_key], owner, SNAPSHOT_LOCK_TTL) > 0
+
+    try:
+        redis_conn.delete(pending_key)
+        while True:
+            changes = _sync(cluster, keep_lock)
+            if changes is None or not redis_conn.delete(pending_key):
+                return changes
+    finally:
+        release_leases([lock_key], owner)
+
+
+def _sync(cluster, keep_lock):
+    """Sync the snapshot of a cluster, holding its lock.
+
+    The snapshot is dated from the start of the sync: a change made while
+    it reads the cluster may be missing from it, so it must not be counted
+    as newer than that change (see is_usable()).
+
+    @param keep_lock: callable renewing the lock, returns False once it's
+        lost (e.g. after a stall longer than SNAPSHOT_LOCK_TTL)
+    @return: see sync_cluster(), None if the lock was lost
+    """
+    started = time.time()
+    listings = {}
+    changes = {}
+    for kind in LIST_FIELDS:
+        listings[kind], changes[kind] = _sync_kind(cluster, kind)
+        if not keep_lock():
+            return None
+    cluster_info = ganeti_utils.cluster_connection(cluster).GetInfo()
+    if not keep_lock():
+        return None
+
+    # Live node figures and instance placement don't bump the node's
+    # serial_no, so they live in their own hash rewritten every sync
+    instances = get_snapshot(cluster, 'instance')
+    node_live = dict((name, dict(row, pinst_list=[], sinst_list=[]))
+                     for name, row in listings['node'].items())
+    for instance in sorted(instances.values(), key=lambda i: i["name"]):
+        if instance["pnode"] in node_live:
+            node_live[instance["pnode"]]["pinst_list"].append(
+                instance["name"])
+        for snode in instance["snodes"] or []:
+            if snode in node_live:
+                node_live[snode]["sinst_list"].append(instance["name"])
+
+    live_key = SNAPSHOT_KEY.format(cluster=cluster, kind='node_live')
+    pipe = redis_conn.pipeline()
+    pipe.delete(live_key)
+    if node_live:
+        pipe.hmset(live_key, dict((name, json.dumps(row))
+                                  for name, row in node_live.items()))
+    pipe.hmset(SNAPSHOT_META_KEY.format(cluster=cluster), {
+        'updated': started,
+        'cluster_info': json.dumps(dict(
+            (field, cluster_info.get(field))
+            for field in CLUSTER_INFO_FIELDS)),
+    })
+    pipe.execute()
+    return changes
+
+
+def get_snapshot(cluster, kind):
+    """Return all snapshot objects of one type as a dict by name."""
+    return dict((name, json.loads(obj)) for name, obj in redis_conn.hgetall(
+        SNAPSHOT_KEY.format(cluster=cluster, kind=kind)).items())
+
+
+def snapshot_age(cluster):
+    """Seconds since the last sync of a cluster, None if never synced."""
+    updated = redis_conn.hget(SNAPSHOT_META_KEY.format(cluster=cluster),
+                              'updated')
+    if updated is None:
+        return None
+    return time.time() - float(updated)
+
+
+def is_usable(cluster):
+    """Whether readers may use the snapshot of a cluster.
+
+    The snapshot must be recent and taken after the last change nodEvac
+    itself made to the cluster.
+    """
+    age = snapshot_age(cluster)
+    if age is None or age > SNAPSHOT_MAX_AGE:
+        return False
+    last_change = cache.last_change(cluster)
+    return last_change is None or time.time() - age > last_change
+
+
+def _with_live_data(node_info, node_live):
+    node_info.update(node_live)
+    node_info["pinst_cnt"] = len(node_info["pinst_list"])
+    node_info["sinst_cnt"] = len(node_info["sinst_list"])
+    node_info["bmc"] = get_bmc_host(node_info["tags"])
+    return node_info
+
+
+def get_node(cluster, node):
+    """Return a node from the snapshot with its live figures, or None."""
+    pipe = redis_conn.pipeline()
+    pipe.hget(SNAPSHOT_KEY.format(cluster=cluster, kind='node'), node)
+    pipe.hget(SNAPSHOT_KEY.format(cluster=cluster, kind='node_live'), node)
+    node_config, node_live = pipe.execute()
+    if node_config is None or node_live is None:
+        return None
+    return _with_live_data(json.loads(node_config), json.loads(node_live))
+
+
+def get_nodes(cluster):
+    """Return all nodes from the snapshot with their live figures."""
+    node_live = get_snapshot(cluster, 'node_live')
+    return [_with_live_data(node_info, node_live[name])
+            for name, node_info in get_snapshot(cluster, 'node').items()
+            if name in node_live]
+
+
+def get_cluster_info(cluster):
+    """Return the cluster info stored with the snapshot, or None."""
+    cluster_info = redis_conn.hget(SNAPSHOT_META_KEY.format(cluster=cluster),
+                                   'cluster_info')
+    if cluster_info is None:
+        return None
+    return json.loads(cluster_info)
+
+
+def get_bmc_host(tags):
+    """Return the BMC hostname from a node's ipmi:<FQDN> tag, or None."""
+    for tag in tags or []:
+        if tag.startswith('ipmi:'):
+            return tag.split(':')[-1]
+    return None
@@ -5,124 +5,1043 @@ import subprocess
 import time
 import re
 
-from celery import Celery
+from celery import Celery, Task, chord, states
 from celery.decorators import task
-import redis
+from celery.signals import worker_process_init, task_postrun
+from celery.exceptions import Ignore, Retry
+from celery.utils import uuid
 
+from contrib.ganeti_client import JOB_STATUS_FINALIZED, JOB_STATUS_RUNNING,\
+    JOB_STATUS_SUCCESS, REPLACE_DISK_CHG, GanetiApiError
 from ganeti_utils import cluster_connection, get_node_info,\
-    get_cluster_info, GANETI_CLUSTER
+    get_cluster_info, query_resource, reset_cluster_connections,\
+    wait_for_job, GANETI_CLUSTER
+from cache import invalidate_node, invalidate_cluster
+from history import estimate_evacuation, job_timestamp, record_migration
+from evacuation import get_evacuation, update_evacuation, end_evacuation,\
+    touch_evacuation, evacuated_nodes, update_progress, get_progress,\
+    claim_migration, get_migration_job, update_migration_claim,\
+    record_migration_job, lock_nodes, MIGRATION_CLAIM_TIMEOUT, FINAL_STATES
 from ipmi import get_ipmi_info
+from job_watcher import watch_job, read_job, JOB_FIELDS, JOB_LOG_LINES
+from jobs import register_job
+from lease import renew_leases, release_leases
+from maintenance import get_maintenance, update_maintenance,\
+    end_maintenance, nodes_out, next_node, MAX_NODES_OUT, OUT_PHASES
+from progress import notify_progress
+from redis_clients import redis_url
+from planner import get_migration_details, plan_migration_order,\
+    migration_target, get_target_candidates, choose_targets,\
+    plan_batch_evacuation, EXTERNALLY_MIRRORED_TEMPLATES
+from snapshot import sync_cluster, SNAPSHOT_INTERVAL
+from throttle import acquire_migration_slot, release_migration_slot,\
+    renew_migration_slot, outbound_migrations, cluster_migrations
 from ici import sched_downtime 
 
-celery_app = Celery('nodevac', broker="redis://localhost:6379/0")
-celery_app.conf.result_backend = "redis://localhost:6379/0"
+celery_app = Celery('nodevac', broker=redis_url('broker'))
+celery_app.conf.result_backend = redis_url('results')
 
-@task(bind=True)
-def evacuate_node_task(self, node_name, cluster_name):
-    """ Handles the tasks needed to evacuate a Ganeti node."""
+# Every task goes to the queue of its kind of work, each served by its own
+# workers (see the README), so hours of migrations and IPMI wait loops never
+# hold up orchestration:
+#   orchestration  quick steps that plan, start and check on other tasks
+#   ganeti         migrations, checking on their Ganeti jobs, and tasks
+#                  blocking on Ganeti jobs
+#   power          IPMI power operations and their wait loops
+celery_app.conf.task_routes = {
+    'tasks.evacuate_node_task': {'queue': 'orchestration'},
+    'tasks.evacuate_nodes_task': {'queue': 'orchestration'},
+    'tasks.finish_evacuation_task': {'queue': 'orchestration'},
+    'tasks.rolling_maintenance_task': {'queue': 'orchestration'},
+    'tasks.snapshot_clusters_task': {'queue': 'orchestration'},
+    'tasks.snapshot_cluster_task': {'queue': 'orchestration'},
+    'tasks.ganeti_evacuation_task': {'queue': 'orchestration'},
+    'tasks.migrate_instance_task': {'queue': 'ganeti'},
+    'tasks.shutdown_node_task': {'queue': 'power'},
+    'tasks.startup_node_task': {'queue': 'power'},
+}
+# Long tasks are acknowledged late, a worker shouldn't reserve more of them
+# than it can run
+celery_app.conf.worker_prefetch_multiplier = 1
+
+celery_app.conf.beat_schedule = {
+    'snapshot-clusters': {
+        'task': 'tasks.snapshot_clusters_task',
+        'schedule': SNAPSHOT_INTERVAL,
+    },
+}
+
+# Seconds between two progress updates of a task that only add to its job
+# log, changes of its state or percent are stored right away
+PROGRESS_MIN_INTERVAL = 2
+# Default number of simultaneous migrations per node evacuation
+EVACUATION_CONCURRENCY = 3
+# Default number of simultaneous migrations in the cluster for a batch
+# evacuation
+BATCH_CONCURRENCY = 6
+# Seconds before a migration waiting for a slot or for its job, or the jobs
+# of a ganeti engine evacuation, are checked again
+MIGRATION_POLL_INTERVAL = 5
+# Lease on an instance migrated on its own (not by an evacuation), taken by
+# the view so that duplicate clicks follow the running migration
+INSTANCE_MIGRATION_KEY = "nodEvac:migrate:{cluster}:{instance}"
+# Seconds the lease lasts without a sign of life from the migration, it's
+# renewed on every check of its job
+INSTANCE_MIGRATION_LOCK_TTL = 900
+# Seconds between two checks of a rolling maintenance
+MAINTENANCE_POLL_INTERVAL = 30
+# Ways evacuate_node_task can migrate instances, see its docstring
+EVACUATION_ENGINES = ('nodevac', 'ganeti')
+# Job fields needed to report the jobs spawned by a MigrateNode job
+GANETI_JOB_FIELDS = ["id", "status", "opstatus", "ops", "start_ts", "end_ts"]
+# Instance fields kept in the migration history
+HISTORY_INSTANCE_FIELDS = ["name", "pnode", "disk_template", "be/maxmem",
+                           "disk.sizes"]
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    """Start every pool process with its own Ganeti connections."""
+    reset_cluster_connections()
+
+def report_migration_progress(evacuation_id, instance_name, task_id,
+                              task_state, task_status):
+    """Store the progress of a migration in its evacuation's progress."""
+    update_progress(evacuation_id, {instance_name: {
+        'task_id': task_id,
+        'task_state': task_state,
+        'task_status': task_status}})
+
+@task_postrun.connect
+def notify_task_done(task_id=None, kwargs=None, retval=None, state=None,
+                     **_):
+    """
+    Announce the result, or retry, of every task. The outcome of the
+    migrations of an evacuation is stored in its progress. Tasks that will
+    be checked again (see check_again()) keep their last progress.
+    """
+    if state == states.IGNORED:
+        return
+    kwargs = kwargs or {}
+    evacuation_id = kwargs.get('evacuation_id')
+    if evacuation_id is not None and kwargs.get('instance_name'):
+        report_migration_progress(
+            evacuation_id, kwargs['instance_name'], task_id, state,
+            migration_task_status({'status': state, 'result': retval}))
+    notify_progress(task_id, evacuation_id)
+
+class ProgressTask(Task):
+    """
+    Task announcing every progress update (see progress.py). Updates are
+    coalesced: one that keeps the state and percent of the last one is
+    deferred until PROGRESS_MIN_INTERVAL has passed since. A deferred update
+    is stored by the next update, or by flush_progress() when the task may
+    not update again for a while. Migrations that are part of an evacuation
+    also store their progress in it.
+    """
+    # (task id, state, percent, time) of the last stored update, per process
+    _last_progress = None
+    # (task id, state, meta) of the deferred update, per process
+    _pending_progress = None
+
+    def update_state(self, task_id=None, state=None, meta=None):
+        task_id = task_id or self.request.id
+        percent = meta.get('percent') if isinstance(meta, dict) else None
+        now = time.time()
+        if self._last_progress is not None:
+            last_task, last_state, last_percent, last_time = \
+                self._last_progress
+            if ((last_task, last_state, last_percent) ==
+                    (task_id, state, percent) and
+                    now - last_time < PROGRESS_MIN_INTERVAL):
+                self._pending_progress = (task_id, state, meta)
+                return
+        self._pending_progress = None
+        self._last_progress = (task_id, state, percent, now)
+        super(ProgressTask, self).update_state(task_id, state, meta)
+        kwargs = self.request.kwargs or {}
+        if (kwargs.get('evacuation_id') is not None and
+                kwargs.get('instance_name')):
+            report_migration_progress(kwargs['evacuation_id'],
+                                      kwargs['instance_name'], task_id,
+                                      state, meta)
+        notify_progress(task_id)
+
+    def flush_progress(self):
+        """Store the deferred update of the current task, if any."""
+        if (self._pending_progress is not None and
+                self._pending_progress[0] == self.request.id):
+            task_id, state, meta = self._pending_progress
+            self._last_progress = None
+            self.update_state(task_id, state, meta)
+
+def check_again(task_obj, countdown, **kwargs):
+    """
+    Run the current task again countdown seconds later, with its kwargs
+    updated with kwargs, under the same task id and chord. Unlike
+    Task.retry() no RETRY state is stored, the task keeps showing its last
+    progress, and there's no limit on how often.
+
+    Raises Ignore so that this run ends without a result. Eager tasks run
+    again right away instead, and the result of their last run is returned.
+    """
+    request = task_obj.request
+    again = task_obj.signature_from_request(
+        request, request.args, dict(request.kwargs or {}, **kwargs),
+        countdown=countdown)
+    if request.is_eager:
+        return again.apply().get()
+    again.apply_async()
+    raise Ignore()
+
+def wait_for_node_job(cluster_conn, job_id, cluster_name, node_name):
+    """
+    Wait for a job that changes a node, dropping cached reads of the node
+    both while the job runs and once it's done.
+    """
+    invalidate_node(cluster_name, node_name)
+    try:
+        return wait_for_job(cluster_conn, job_id)
+    finally:
+        invalidate_node(cluster_name, node_name)
+        snapshot_cluster_task.delay(cluster_name)
+
+def get_task_metas(task_ids):
+    """
+    Read the state and result of many tasks from the result backend with a
+    single MGET, instead of a round-trip per AsyncResult.
+
+    @return: dict of task id to its meta (status, result), PENDING for
+        unknown tasks like AsyncResult
+    """
+    task_ids = list(task_ids)
+    if not task_ids:
+        return {}
+    backend = celery_app.backend
+    values = backend.mget([backend.get_key_for_task(task_id)
+                           for task_id in task_ids])
+    return dict((task_id, backend.decode_result(value) if value is not None
+                 else {'status': states.PENDING, 'result': None})
+                for task_id, value in zip(task_ids, values))
+
+def migration_task_status(task_meta):
+    """
+    Return the progress meta of a migrate_instance_task, in the shape the node
+    page expects even if the task crashed or is waiting for a slot.
+
+    @param task_meta: the task's meta, see get_task_metas()
+    """
+    if task_meta['status'] == states.FAILURE:
+        return failed_migration(str(task_meta['result']))
+    if task_meta['status'] == states.RETRY:
+        return {'percent': 0,
+                'status': "Waiting for a free migration slot.",
+                'job_status': 'Pending',
+                'job_details': {'opstatus': ['waiting']}}
+    return task_meta['result']
+
+def get_migration_progress(task_ids):
+    """
+    Progress of many migrate_instance_tasks, read with a single MGET.
+
+    @return: dict of task id to a dict with the task_id, task_state and
+        task_status (see migration_task_status()) of the task
+    """
+    return dict((task_id, {'task_id': task_id,
+                           'task_state': task_meta['status'],
+                           'task_status': migration_task_status(task_meta)})
+                for task_id, task_meta in get_task_metas(task_ids).items())
+
+def migration_succeeded(migration):
+    """Whether a migrate_instance_task result is a successful migration."""
+    return migration.get('job_status') == 'Success'
+
+def failed_migration(message, instance_name=None):
+    """A migrate_instance_task result for a migration that never ran."""
+    return {'percent': 100,
+            'instance_name': instance_name,
+            'status': message,
+            'job_status': 'Failure',
+            'job_details': {'opstatus': ['error']}}
+
+def get_evacuation_status(evacuation_id, since=0):
+    """
+    Return the state of an evacuation and its status and progress in the
+    shape the node page expects, or None if it hasn't started yet.
+    The progress of the nodevac engine's migrations also gives the estimated
+    seconds left (eta, None if unknown).
+
+    @param since: a progress version from an earlier status, to only get the
+        progress entries that changed after it
+    """
+    evacuation = get_evacuation(evacuation_id)
+    if evacuation is None:
+        return None
+    evac_status = evacuation["status"]
+    version, migration_progress, changed = get_progress(evacuation_id,
+                                                        since)
+    migration_tasks = evacuation.get("tasks", {})
+    instances = dict((instance["name"], instance)
+                     for instance in evacuation.get("instances") or [])
+    unfinished = []
+    elapsed = {}
+    if migration_tasks:
+        evac_status["inst_done"] = 0
+        evac_status["inst_failed"] = []
+    for instance, task_id in migration_tasks.items():
+        progress = migration_progress.get(instance) or {}
+        if progress.get('task_id') != task_id:
+            # Not started yet, or left by the run of a resumed evacuation
+            progress = {}
+        task_status = progress.get('task_status')
+        if progress.get('task_state') not in states.READY_STATES:
+            unfinished.append(instances.get(instance, {'name': instance}))
+            start_ts = job_timestamp(((task_status or {}).get(
+                'job_details') or {}).get('start_ts'))
+            if start_ts is not None:
+                elapsed[instance] = time.time() - start_ts
+            continue
+        if migration_succeeded(task_status):
+            evac_status["inst_done"] += 1
+        else:
+            evac_status["inst_failed"].append(instance)
+
+    eta = None
+    if evacuation["state"] in ('SUCCESS', 'FAILURE'):
+        eta = 0
+    elif instances:
+        options = evacuation.get("options") or {}
+        concurrency = options.get("concurrency", EVACUATION_CONCURRENCY)
+        if not migration_tasks:
+            # Not migrating yet
+            unfinished = instances.values()
+        eta = estimate_evacuation(unfinished, concurrency, elapsed)
+    return {'state': evacuation["state"],
+            'status': evac_status,
+            'progress': dict((instance, migration_progress[instance])
+                             for instance in changed),
+            'version': version,
+            'eta': eta,
+            'error': evacuation.get("message")}
+
+def reserve_migration(instance_info, cluster_name, source_node,
+                      target_node=None, iallocator=None,
+                      concurrency=EVACUATION_CONCURRENCY, cluster_limit=None):
+    """
+    Reserve a slot on the source and on the target node of a migration (see
+    throttle.py). Externally mirrored instances go to target_node, or to
+    iallocator's choice, or else to the least busy node of the group that
+    has room for them.
+
+    @param instance_info: instance dict, see ganeti_utils.INSTANCE_INFO_FIELDS
+    @param cluster_limit: optional limit of migrations in the whole cluster
+    @return: the reserved [source, target] pair, or None if there's no slot
+    """
+    if outbound_migrations(cluster_name, source_node) >= concurrency:
+        return None
+    if (cluster_limit is not None and
+            cluster_migrations(cluster_name) >= cluster_limit):
+        return None
+    target = migration_target(instance_info, target_node)
+    if (target is None and iallocator is None and
+            instance_info.get("disk_template") in
+            EXTERNALLY_MIRRORED_TEMPLATES):
+        targets = choose_targets(instance_info,
+                                 get_target_candidates(source_node,
+                                                       cluster_name),
+                                 cluster_name)
+    else:
+        targets = [target]
+    for target in targets:
+        if acquire_migration_slot(cluster_name, instance_info["name"],
+                                  source_node, target, concurrency,
+                                  cluster_limit):
+            return [source_node, target]
+    return None
+
+def ganeti_job_progress(job):
+    """
+    Translate a Ganeti job, as returned by a job query, into the per-instance
+    progress entry migrate_instance_task reports.
+    """
+    job_details = {'id': job["id"], 'status': job["status"],
+                   'opstatus': job["opstatus"],
+                   'start_ts': job["start_ts"], 'end_ts': job["end_ts"]}
+    if job["status"] == JOB_STATUS_SUCCESS:
+        task_status = {'percent': 100, 'job_status': 'Success',
+                       'status': "Migration Complete!"}
+    elif job["status"] in JOB_STATUS_FINALIZED:
+        task_status = {'percent': 100, 'job_status': 'Failure',
+                       'status': "Migration Failed!"}
+    elif job["status"] == JOB_STATUS_RUNNING:
+        task_status = {'percent': 50, 'job_status': 'Pending',
+                       'status': "Job Submitted."}
+    else:
+        task_status = {'percent': 20, 'job_status': 'Pending',
+                       'status': "Job Submitted."}
+    task_status['job_id'] = job["id"]
+    task_status['job_details'] = job_details
+    if job["status"] in JOB_STATUS_FINALIZED:
+        task_state = 'SUCCESS'
+    else:
+        task_state = 'JPENDING'
+    return {'task_state': task_state, 'task_status': task_status}
+
+def offline_evacuated_node(evacuation_id, inst_failed):
+    """
+    Last step of an evacuation: offline every evacuated node, except those
+    where some instances failed to migrate, and close the evacuation record.
+    """
+    evacuation = get_evacuation(evacuation_id)
+    cluster_name = evacuation["cluster_name"]
+    evac_status = evacuation["status"]
+
+    # Instances a batch evacuation couldn't place count as failed
+    unmovable = evacuation.get("unmovable") or []
+    inst_failed = inst_failed + [instance["name"] for instance in unmovable]
+    evac_status["inst_failed"] = inst_failed
+    # Failures the planned instances don't explain (e.g. a failed MigrateNode
+    # job) keep the evacuated node online
+    pnodes = dict((instance["name"],
+                   instance.get("pnode") or evacuation["node_name"])
+                  for instance in (evacuation.get("instances") or []) +
+                  unmovable)
+    failed_nodes = set(pnodes.get(instance, evacuation["node_name"])
+                       for instance in inst_failed)
+    offlined = evacuation.get("offlined") or []
+    cluster_conn = cluster_connection(cluster_name)
+    evac_status["inst_done"] = evac_status["pinst_cnt"] - len(inst_failed)
+    update_evacuation(evacuation_id, state='E_OFFLINING', status=evac_status)
+    if inst_failed:
+        # Instances are still running on these nodes, leave them drained
+        print("Migrations failed for: " + str(evac_status["inst_failed"]))
+    for node_name in evacuated_nodes(evacuation):
+        if node_name in failed_nodes or node_name in offlined:
+            continue
+        print("Node " + node_name + " emptied. Continuing.")
+        node_offline_job = cluster_conn.SetNodeRole(node_name, "offline")
+        node_offline_job_status = wait_for_node_job(
+            cluster_conn, node_offline_job, cluster_name, node_name)
+        if node_offline_job_status and evacuation["node_name"]:
+            evac_status["role"] = "Offline"
+            print("Node offlined.")
+        offlined.append(node_name)
+        update_evacuation(evacuation_id, status=evac_status,
+                          offlined=offlined)
+    end_evacuation(evacuation_id, 'SUCCESS', status=evac_status)
+    return evac_status
+
+def migration_signature(instance_info, evacuation_id, cluster_name,
+                        **kwargs):
+    """
+    Return the migrate_instance_task of one instance of an evacuation,
+    with the given extra arguments.
+    """
+    kwargs.update(instance_name=instance_info["name"],
+                  cluster_name=cluster_name,
+                  instance_info=instance_info,
+                  evacuation_id=evacuation_id)
+    return migrate_instance_task.signature(kwargs=kwargs).set(task_id=uuid())
+
+def launch_migrations(evacuation_id, migrations):
+    """
+    Start a chord of migration signatures (see migration_signature) with
+    finish_evacuation_task as its callback, and record their task ids.
+    """
+    update_evacuation(evacuation_id, state='E_MIGRATING', tasks=dict(
+        (migration["kwargs"]["instance_name"], migration.id)
+        for migration in migrations))
+    chord(migrations)(finish_evacuation_task.s(evacuation_id))
+
+@task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def evacuate_node_task(self, node_name, cluster_name,
+                       concurrency=EVACUATION_CONCURRENCY, engine='nodevac',
+                       order='default', target_node=None, iallocator=None):
+    """
+    Handles the tasks needed to evacuate a Ganeti node.
+
+    This task tags and drains the node, then hands over without waiting:
+    engine 'nodevac' starts a chord of one migrate_instance_task per
+    instance, ordered by the `order` policy (see planner.ORDERING_POLICIES)
+    and limited to `concurrency` at a time, with finish_evacuation_task as
+    its callback. target_node or iallocator choose where externally mirrored
+    instances go. Engine 'ganeti' submits one MigrateNode job, leaving the
+    migrations to Ganeti, and follows it with ganeti_evacuation_task.
+    Progress is kept in the evacuation record, see evacuation.py.
+
+    The task id is the evacuation id. Running the task again with the same
+    id (a redelivery after its worker died, or a resume from the view)
+    skips every checkpointed step and restarts the migrations, which follow
+    the Ganeti jobs already submitted instead of migrating again.
+    """
     print("Begin node evacuation task for node " + node_name)
-    evac_status = {}
+    evacuation_id = self.request.id
+    cluster_conn = cluster_connection(cluster_name)
+
+    evacuation = get_evacuation(evacuation_id)
+    if evacuation is not None:
+        print("Resuming evacuation " + evacuation_id)
+        evac_status = evacuation["status"]
+    else:
+        evacuation = {}
+        evac_status = {}
+        node_info = get_node_info(node_name, cluster_name)
+        evac_status["role"] = node_info["role"]
+        evac_status["pinst_cnt"] = node_info["pinst_cnt"]
+        evac_status["inst_done"] = 0
+        evac_status["inst_failed"] = []
+        evac_status["engine"] = engine
+        evac_status["order"] = order
+        print(evac_status)
+        register_job(evacuation_id, 'evacuation', cluster_name, [node_name])
+        update_evacuation(evacuation_id, node_name=node_name,
+                          cluster_name=cluster_name, state='E_STARTED',
+                          status=evac_status, options={
+                              'node_name': node_name,
+                              'cluster_name': cluster_name,
+                              'concurrency': concurrency,
+                              'engine': engine,
+                              'order': order,
+                              'target_node': target_node,
+                              'iallocator': iallocator})
+
+    try:
+        if not evacuation.get("tagged"):
+            maintenancetag_job = cluster_conn.AddNodeTags(node_name,
+                                                          ['maintenance'])
+            wait_for_node_job(cluster_conn, maintenancetag_job,
+                              cluster_name, node_name)
+            update_evacuation(evacuation_id, tagged=True)
 
+        if not evacuation.get("drained"):
+            if evac_status["role"] != "Drained":
+                print('Current role is :' + evac_status["role"] +
+                      ". Draining...")
+                node_drain_job = cluster_conn.SetNodeRole(node_name,
+                                                          "drained")
+                node_drain_job_status = wait_for_node_job(
+                    cluster_conn, node_drain_job, cluster_name, node_name)
+                if node_drain_job_status:
+                    evac_status["role"] = "Drained"
+                    print("Node drained.")
+            update_evacuation(evacuation_id, state='E_DRAINED',
+                              status=evac_status, drained=True)
+
+        if engine == 'ganeti':
+            migrate_node_job = evacuation.get("migrate_node_job")
+            if migrate_node_job is None:
+                print("Submitting node migration job...")
+                migrate_node_job = cluster_conn.MigrateNode(node_name)
+                invalidate_cluster(cluster_name)
+                update_evacuation(evacuation_id, state='E_MIGRATING',
+                                  migrate_node_job=migrate_node_job)
+            ganeti_evacuation_task.apply_async(
+                args=[evacuation_id, cluster_name, migrate_node_job])
+            return evacuation_id
+
+        instances = evacuation.get("instances")
+        if instances is None:
+            node_info = get_node_info(node_name, cluster_name,
+                                      fields=["pinst_list"])
+            details = get_migration_details(node_name, cluster_name)
+            instances = [details.get(instance, {'name': instance})
+                         for instance in plan_migration_order(
+                             node_info["pinst_list"], details, order)]
+            update_evacuation(evacuation_id, instances=instances)
+        if not instances:
+            offline_evacuated_node(evacuation_id, [])
+            return evacuation_id
+
+        print("Spawning migrate jobs...")
+        print("Running VMs:" + str([instance["name"]
+                                    for instance in instances]))
+        launch_migrations(evacuation_id, [
+            migration_signature(instance, evacuation_id, cluster_name,
+                                source_node=node_name,
+                                concurrency=concurrency,
+                                target_node=target_node,
+                                iallocator=iallocator)
+            for instance in instances])
+    except Exception as error:
+        end_evacuation(evacuation_id, 'FAILURE', message=str(error))
+        raise
+    return evacuation_id
+
+@task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def evacuate_nodes_task(self, node_names, cluster_name,
+                        concurrency=BATCH_CONCURRENCY):
+    """
+    Evacuate a set of nodes at once, e.g. a whole rack.
+
+    Every node is tagged and drained up front. A single placement plan (see
+    planner.plan_batch_evacuation) then sends each instance to a node
+    outside of the set, so nothing moves twice. The migrations run as a
+    chord like in evacuate_node_task, at most `concurrency` at a time in the
+    whole cluster on top of the per node limits. Nodes whose instances all
+    left are offlined. Checkpoints and resuming work like in
+    evacuate_node_task.
+    """
+    print("Begin batch evacuation of nodes " + ", ".join(node_names))
+    evacuation_id = self.request.id
     cluster_conn = cluster_connection(cluster_name)
-    node_info = get_node_info(node_name, cluster_name)
-
-    evac_status["role"] = node_info["role"]
-    evac_status["pinst_cnt"] = node_info["pinst_cnt"]
-    evac_status["inst_done"] = 0
-    print(evac_status)
-    self.update_state(state='E_STARTED',
-                      meta={'status': evac_status})
-
-    maintenancetag_job = cluster_conn.AddNodeTags(node_name, ['maintenance'])
-    cluster_conn.WaitForJobCompletion(maintenancetag_job)
-
-    if evac_status["role"] != "Drained":
-        print('Current role is :' + evac_status["role"] + ". Draining...")
-        node_drain_job = cluster_conn.SetNodeRole(node_name, "drained")
-        node_drain_job_status = cluster_conn.WaitForJobCompletion(node_drain_job)
-        if node_drain_job_status:
+
+    evacuation = get_evacuation(evacuation_id)
+    if evacuation is not None:
+        print("Resuming evacuation " + evacuation_id)
+        evac_status = evacuation["status"]
+    else:
+        evacuation = {}
+        evac_status = {'role': None, 'pinst_cnt': 0, 'inst_done': 0,
+                       'inst_failed': [], 'engine': 'batch',
+                       'order': 'placement'}
+        register_job(evacuation_id, 'batch_evacuation', cluster_name,
+                     node_names)
+        update_evacuation(evacuation_id, node_name=None,
+                          node_names=node_names, cluster_name=cluster_name,
+                          state='E_STARTED', status=evac_status, options={
+                              'node_names': node_names,
+                              'cluster_name': cluster_name,
+                              'concurrency': concurrency})
+
+    try:
+        if not evacuation.get("tagged"):
+            tag_jobs = [(node_name,
+                         cluster_conn.AddNodeTags(node_name, ['maintenance']))
+                        for node_name in node_names]
+            for node_name, tag_job in tag_jobs:
+                wait_for_node_job(cluster_conn, tag_job, cluster_name,
+                                  node_name)
+            update_evacuation(evacuation_id, tagged=True)
+
+        if not evacuation.get("drained"):
+            print("Draining " + ", ".join(node_names))
+            drain_jobs = [(node_name,
+                           cluster_conn.SetNodeRole(node_name, "drained"))
+                          for node_name in node_names]
+            for node_name, drain_job in drain_jobs:
+                wait_for_node_job(cluster_conn, drain_job, cluster_name,
+                                  node_name)
             evac_status["role"] = "Drained"
-            print("Node drained.")
-    self.update_state(state='E_DRAINED',
-                      meta={'status': evac_status})
-
-    print("Spawning migrate jobs...")
-    print ("Running VMs:" + str(node_info["pinst_list"]))
-    # This dict will hold the task
-    # current status of each task
+            update_evacuation(evacuation_id, state='E_DRAINED',
+                              status=evac_status, drained=True)
+
+        instances = evacuation.get("instances")
+        if instances is None:
+            plan = plan_batch_evacuation(node_names, cluster_name)
+            instances = plan['migrations']
+            evac_status["pinst_cnt"] = len(instances) + len(plan['unmovable'])
+            update_evacuation(evacuation_id, status=evac_status,
+                              instances=instances,
+                              unmovable=plan['unmovable'],
+                              degraded=plan['degraded'])
+        if not instances:
+            offline_evacuated_node(evacuation_id, [])
+            return evacuation_id
+
+        print("Spawning migrate jobs...")
+        migrations = []
+        for instance in instances:
+            instance_info = dict(instance)
+            if instance["new_secondary"]:
+                # Throttled as a migration to where its secondary will be
+                instance_info["snodes"] = [instance["new_secondary"]]
+            migrations.append(migration_signature(
+                instance_info, evacuation_id, cluster_name,
+                source_node=instance["pnode"],
+                target_node=instance["target"],
+                new_secondary=instance["new_secondary"],
+                cluster_limit=concurrency))
+        launch_migrations(evacuation_id, migrations)
+    except Exception as error:
+        end_evacuation(evacuation_id, 'FAILURE', message=str(error))
+        raise
+    return evacuation_id
+
+@task(acks_late=True, reject_on_worker_lost=True)
+def finish_evacuation_task(migrations, evacuation_id):
+    """
+    Chord callback of a nodevac engine evacuation, runs once every
+    migrate_instance_task is done.
+    """
+    return offline_evacuated_node(evacuation_id, [
+        migration["instance_name"] for migration in migrations
+        if not migration_succeeded(migration)])
+
+@task(bind=True, acks_late=True, reject_on_worker_lost=True,
+      max_retries=None)
+def ganeti_evacuation_task(self, evacuation_id, cluster_name,
+                           migrate_node_job):
+    """
+    Follow the MigrateNode job of a ganeti engine evacuation and the
+    per-instance jobs it spawns. Every run checks them once with a single
+    job query and retries the task, with no limit, until they are all done,
+    then offlines the node.
+    """
+    cluster_conn = cluster_connection(cluster_name)
+    migrate_node_details = cluster_conn.GetJobStatus(migrate_node_job)
+    if migrate_node_details["status"] not in JOB_STATUS_FINALIZED:
+        raise self.retry(countdown=MIGRATION_POLL_INTERVAL)
+
+    inst_failed = []
+    child_jobs = []
+    # The job result lists the jobs it submitted: [[success, job id], ...]
+    opresult = (migrate_node_details["opresult"] or [None])[0]
+    if migrate_node_details["status"] != JOB_STATUS_SUCCESS:
+        inst_failed.append(str(opresult))
+    else:
+        for submitted, job_id in opresult["jobs"]:
+            if submitted:
+                child_jobs.append(int(job_id))
+            else:
+                inst_failed.append(job_id)
+
     migration_progress = {}
-    for instance in node_info["pinst_list"]:
-        jobid = migrate_instance_task.apply_async(kwargs={
-            'instance_name': instance,
-            'cluster_name': cluster_name
-        })
-        migration_progress[instance] = {}
-        migration_progress[instance]["task_id"] = str(jobid)
-        self.update_state(state='E_MIGRATING',
-                          meta={'status': evac_status,
-                                'progress': migration_progress
-                               }
-                         )
-        while jobid.state in ["PENDING", "JSTARTED", "JPENDING"]:
-            time.sleep(10)
-            migration_progress[instance]["task_state"] = jobid.state
-            migration_progress[instance]["task_status"] = jobid.info
-            self.update_state(state='E_MIGRATING',
-                              meta={'status': evac_status,
-                                    'progress': migration_progress
-                                   }
-                             )
-        evac_status["inst_done"] += 1
-        print("VMs done:" + str(evac_status["inst_done"]) +
-              "/" + str(evac_status["pinst_cnt"]))
-        self.update_state(state='E_MIGRATING',
-                          meta={'status': evac_status,
-                                'progress': migration_progress
-                               }
-                         )
-    print("Node emptied. Continuing.")
-    node_offline_job = cluster_conn.SetNodeRole(node_name, "offline")
-    node_offline_job_status = cluster_conn.WaitForJobCompletion(node_offline_job)
-    if node_offline_job_status:
-        evac_status["role"] = "Offline"
-        print("Node drained.")
-
-    # Remove the redis key refering to this task, now that we are done.k
-    redis_conn = redis.StrictRedis()
-    redis_key = ('nodEvac:evacuate_node:' + cluster_name + ":" + node_name)
-    redis_conn.delete(redis_key)
-
-    self.update_state(state='E_OFFLINING',
-                      meta={'status': evac_status,
-                            'progress': migration_progress
-                           }
-                     )
-    return {'status': evac_status, 'progress': migration_progress}
-
-@task(bind=True)
-def migrate_instance_task(self, instance_name, cluster_name):
-    """Migrate a Ganeti instance"""
+    unfinished = False
+    if child_jobs:
+        jobs = query_resource(cluster_name, "job", GANETI_JOB_FIELDS,
+                              ["|"] + [["=", "id", job_id]
+                                       for job_id in child_jobs])
+        for job in jobs:
+            instance = job["ops"][0].get("instance_name", str(job["id"]))
+            migration_progress[instance] = ganeti_job_progress(job)
+            if job["status"] not in JOB_STATUS_FINALIZED:
+                unfinished = True
+            elif job["status"] != JOB_STATUS_SUCCESS:
+                inst_failed.append(instance)
+    update_progress(evacuation_id, migration_progress)
+    touch_evacuation(evacuation_id)
+    if unfinished:
+        raise self.retry(countdown=MIGRATION_POLL_INTERVAL)
+    invalidate_cluster(cluster_name)
+    snapshot_cluster_task.delay(cluster_name)
+    return offline_evacuated_node(evacuation_id, inst_failed)
+
+@task(bind=True, base=ProgressTask, acks_late=True,
+      reject_on_worker_lost=True, max_retries=None)
+def migrate_instance_task(self, instance_name, cluster_name, target_node=None,
+                          iallocator=None, source_node=None,
+                          concurrency=EVACUATION_CONCURRENCY,
+                          instance_info=None, evacuation_id=None,
+                          new_secondary=None, cluster_limit=None,
+                          migrate_job_id=None, migration_slot=None,
+                          instance_before=None):
+    """
+    Migrate a Ganeti instance
+
+    Migrations that are part of an evacuation (of source_node) first reserve
+    a slot on the source and target node with reserve_migration(), retrying
+    the task, with no limit, until they get one. They report errors raised
+    before their job exists, or its disappearance, as a failed migration
+    instead of raising, so the evacuation's chord callback always runs, see
+    migrate_evacuated_instance(). Other errors while the job runs only
+    delay the next check, see follow_migration().
+    Their Ganeti job is checkpointed in the evacuation record: a task run
+    again for the same instance follows that job instead of migrating again.
+    DRBD instances with a new_secondary first get their secondary moved
+    there, see change_secondary().
+
+    Once the job is submitted the task checks on it every
+    MIGRATION_POLL_INTERVAL seconds, see follow_migration(): these runs get
+    the job (migrate_job_id), the slot and the instance_before the
+    migration. The slot, or for other migrations the instance's
+    INSTANCE_MIGRATION_KEY lease, is freed when the task is done.
+    """
+    followed = False
+    try:
+        if migrate_job_id is not None:
+            return follow_migration(self, instance_name, cluster_name,
+                                    migrate_job_id, instance_before,
+                                    evacuation_id, migration_slot)
+        if evacuation_id is None:
+            return migrate_instance(self, instance_name, cluster_name,
+                                    target_node, iallocator)
+        return migrate_evacuated_instance(
+            self, instance_name, cluster_name, target_node, iallocator,
+            source_node, concurrency, instance_info, evacuation_id,
+            new_secondary, cluster_limit)
+    except Ignore:
+        # Checked again later, the lease or slot goes with it
+        followed = True
+        raise
+    except Retry:
+        raise
+    except Exception as error:
+        if evacuation_id is None:
+            raise
+        return failed_migration(str(error), instance_name)
+    finally:
+        if followed:
+            pass
+        elif evacuation_id is None:
+            release_leases([INSTANCE_MIGRATION_KEY.format(
+                cluster=cluster_name, instance=instance_name)],
+                           self.request.id)
+        elif migration_slot is not None:
+            release_migration_slot(cluster_name, instance_name,
+                                   *migration_slot)
+
+def migrate_evacuated_instance(migrate_task, instance_name, cluster_name,
+                               target_node, iallocator, source_node,
+                               concurrency, instance_info, evacuation_id,
+                               new_secondary, cluster_limit):
+    """
+    Migrate an instance as part of an evacuation, see migrate_instance_task.
+    Raises Retry while the migration has to wait.
+    """
+    migration = get_migration_job(evacuation_id, instance_name)
+    if migration is not None and migration["job_id"] is not None:
+        print("Following migration job " + str(migration["job_id"]))
+        return follow_migration(migrate_task, instance_name, cluster_name,
+                                migration["job_id"],
+                                evacuation_id=evacuation_id)
+    if migration is not None:
+        if time.time() - migration["claimed"] < MIGRATION_CLAIM_TIMEOUT:
+            # Another run of this migration is submitting its job. The wait
+            # ends once it does, or once its claim goes stale and is taken
+            # over below, the task itself retries without a limit
+            raise migrate_task.retry(countdown=MIGRATION_POLL_INTERVAL)
+        # The run that claimed it died before submitting the migration
+        instance = query_resource(cluster_name, "instance", ["pnode"],
+                                  ["=", "name", instance_name])
+        if instance and instance[0]["pnode"] != source_node:
+            return {'percent': 100,
+                    'instance_name': instance_name,
+                    'status': "Instance already migrated.",
+                    'job_status': 'Success',
+                    'job_details': {'opstatus': ['success']}}
+
+    instance_info = instance_info or {'name': instance_name}
+    migration_slot = reserve_migration(instance_info, cluster_name,
+                                       source_node, target_node, iallocator,
+                                       concurrency, cluster_limit)
+    if migration_slot is None:
+        touch_evacuation(evacuation_id)
+        raise migrate_task.retry(countdown=MIGRATION_POLL_INTERVAL)
+    followed = False
+    try:
+        if migration is None:
+            if claim_migration(evacuation_id, instance_name) is not None:
+                # Claimed by another run in between, wait for it as above
+                raise migrate_task.retry(countdown=MIGRATION_POLL_INTERVAL)
+        else:
+            # Take over the stale claim, keeping its secondary_job_id
+            update_migration_claim(evacuation_id, instance_name)
+        if new_secondary is not None and not change_secondary(
+                migrate_task, instance_name, cluster_name, new_secondary,
+                evacuation_id, (migration or {}).get("secondary_job_id"),
+                migration_slot):
+            return failed_migration("Moving the secondary to %s failed." %
+                                    new_secondary, instance_name)
+        if (instance_info.get("disk_template") in
+                EXTERNALLY_MIRRORED_TEMPLATES):
+            target_node = migration_slot[1]
+            if target_node is not None:
+                iallocator = None
+        else:
+            target_node = iallocator = None
+        return migrate_instance(migrate_task, instance_name, cluster_name,
+                                target_node, iallocator,
+                                evacuation_id=evacuation_id,
+                                migration_slot=migration_slot)
+    except Ignore:
+        # Its job is followed by later runs of the task, which free the slot
+        followed = True
+        raise
+    finally:
+        if not followed:
+            release_migration_slot(cluster_name, instance_name,
+                                   *migration_slot)
+
+def change_secondary(migrate_task, instance_name, cluster_name, new_secondary,
+                     evacuation_id, secondary_job_id=None,
+                     migration_slot=None):
+    """
+    Move the DRBD secondary of an instance to new_secondary, so it can be
+    migrated there, unless it's already there. The job is checkpointed in
+    the migration's claim, a resumed run follows it instead.
+
+    @param migration_slot: the [source, target] slot of the migration, kept
+        while the disks sync
+
+    @return: True if new_secondary is the instance's secondary
+    """
+    cluster_conn = cluster_connection(cluster_name)
+    if secondary_job_id is None:
+        instance = query_resource(cluster_name, "instance", ["snodes"],
+                                  ["=", "name", instance_name])
+        if instance and instance[0]["snodes"] == [new_secondary]:
+            return True
+        secondary_job_id = cluster_conn.ReplaceInstanceDisks(
+            instance_name, mode=REPLACE_DISK_CHG, remote_node=new_secondary)
+        update_migration_claim(evacuation_id, instance_name,
+                               secondary_job_id=secondary_job_id)
+    invalidate_cluster(cluster_name)
+    migrate_task.update_state(state='JPENDING',
+                              meta={
+                                  'percent': '10',
+                                  'job_id': secondary_job_id,
+                                  'job_status': 'Pending',
+                                  'status': "Moving secondary to " +
+                                            new_secondary + ".",
+                                  'job_details': {'opstatus': ['running']}})
+
+    def keep_claim():
+        """Disk syncs take long, show the claim's owner is still alive."""
+        migrate_task.flush_progress()
+        update_migration_claim(evacuation_id, instance_name)
+        touch_evacuation(evacuation_id)
+        if migration_slot is not None:
+            renew_migration_slot(cluster_name, instance_name,
+                                 *migration_slot)
+
+    try:
+        return wait_for_job(cluster_conn, secondary_job_id,
+                            on_change=lambda job_info, log_entries:
+                            keep_claim(),
+                            on_wait=keep_claim)
+    finally:
+        invalidate_cluster(cluster_name)
+
+def migrate_instance(migrate_task, instance_name, cluster_name,
+                     target_node=None, iallocator=None, evacuation_id=None,
+                     migration_slot=None):
+    """
+    Submit the migration of an instance and follow its job, reporting
+    progress in migrate_task's meta, see follow_migration().
+
+    @param evacuation_id: evacuation to checkpoint the job in and keep alive
+    @param migration_slot: the [source, target] slot of the migration (see
+        throttle.py), renewed while the job runs
+    """
     message = "Connecting to cluster..."
-    self.update_state(state='JSTARTED',
+    migrate_task.update_state(state='JSTARTED',
                       meta={'percent': '10', 'status': message})
 
     cluster_conn = cluster_connection(cluster_name)
+    instance_before = (query_resource(cluster_name, "instance",
+                                      HISTORY_INSTANCE_FIELDS,
+                                      ["=", "name", instance_name]) or
+                       [{'name': instance_name}])[0]
     migrate_job_id = cluster_conn.MigrateInstance(
-        instance_name, allow_failover=True)
+        instance_name, allow_failover=True, target_node=target_node,
+        iallocator=iallocator)
+    # From here on the migration runs: an error must not free its slot or
+    # fail it, the checks of the task carry the job id along
+    try:
+        if evacuation_id is not None:
+            record_migration_job(evacuation_id, instance_name,
+                                 migrate_job_id)
+        # Have the job watcher follow the job for the checks of this task
+        watch_job(cluster_name, migrate_job_id)
+        # The instance moves between nodes, drop every cached read of the
+        # cluster
+        invalidate_cluster(cluster_name)
+    except Exception as error:
+        print("Recording migration job " + str(migrate_job_id) +
+              " failed: " + str(error))
+    return follow_migration(migrate_task, instance_name, cluster_name,
+                            migrate_job_id, instance_before, evacuation_id,
+                            migration_slot)
 
+def follow_migration(migrate_task, instance_name, cluster_name,
+                     migrate_job_id, instance_before=None,
+                     evacuation_id=None, migration_slot=None):
+    """
+    Check on a submitted migration job, see check_migration(). While the job
+    runs the task is checked again MIGRATION_POLL_INTERVAL seconds later,
+    see check_again(), so it doesn't hold a worker process for the whole
+    migration.
+
+    The job runs whatever happens to a check: an error (e.g. a RAPI timeout
+    or a redis failure) only means checking again, keeping the slot and the
+    claim. Only a job the cluster doesn't know raises.
+
+    @param instance_before: the instance before the migration, for its
+        history, queried now if missing
+    @param evacuation_id: evacuation to keep alive
+    @param migration_slot: the [source, target] slot of the migration (see
+        throttle.py), renewed while the job runs
+    @return: the result of the migration, once its job is finalized
+    """
+    result = None
+    try:
+        if instance_before is None:
+            instance_before = (query_resource(cluster_name, "instance",
+                                              HISTORY_INSTANCE_FIELDS,
+                                              ["=", "name", instance_name]) or
+                               [{'name': instance_name}])[0]
+        result = check_migration(migrate_task, instance_name, cluster_name,
+                                 migrate_job_id, instance_before,
+                                 evacuation_id, migration_slot)
+    except Exception as error:
+        if isinstance(error, GanetiApiError) and error.code == 404:
+            # The job is gone, there's nothing left to follow
+            raise
+        print("Checking migration job " + str(migrate_job_id) +
+              " failed: " + str(error))
+    if result is not None:
+        return result
+    # Nothing is stored until the next check
+    migrate_task.flush_progress()
+    return check_again(migrate_task, MIGRATION_POLL_INTERVAL,
+                       migrate_job_id=migrate_job_id,
+                       migration_slot=migration_slot,
+                       instance_before=instance_before)
+
+def check_migration(migrate_task, instance_name, cluster_name,
+                    migrate_job_id, instance_before, evacuation_id=None,
+                    migration_slot=None):
+    """
+    Check a migration job once, reporting progress in migrate_task's meta.
+    The job's state is read from the job watcher (see job_watcher.py), or
+    from the cluster if no watcher follows it. See follow_migration() for
+    the parameters.
+
+    @return: the result of the migration once its job is finalized, None
+        while it runs
+    """
+    cluster_conn = cluster_connection(cluster_name)
+    job = read_job(cluster_name, migrate_job_id)
+    if job is None:
+        job_status = cluster_conn.GetJobStatus(migrate_job_id)
+        job = dict((field, job_status[field]) for field in JOB_FIELDS)
+        job["log"] = [entry[3] for op_log in job_status["oplog"]
+                      for entry in op_log][-JOB_LOG_LINES:]
+    job_log = job.pop("log")
+
+    if job["status"] not in JOB_STATUS_FINALIZED:
+        # Show the migration is still followed, however quiet its job: keep
+        # its evacuation's heartbeat, or the instance's lease, and its slot
+        # fresh
+        if evacuation_id is not None:
+            touch_evacuation(evacuation_id)
+        else:
+            lock_key = INSTANCE_MIGRATION_KEY.format(cluster=cluster_name,
+                                                     instance=instance_name)
+            renew_leases([lock_key], migrate_task.request.id,
+                         INSTANCE_MIGRATION_LOCK_TTL)
+        if migration_slot is not None:
+            renew_migration_slot(cluster_name, instance_name,
+                                 *migration_slot)
+        migrate_task.update_state(state='JPENDING',
+                          meta={
+                              'percent': ('50' if job["status"] ==
+                                          JOB_STATUS_RUNNING else '20'),
+                              'job_id': migrate_job_id,
+                              'job_status': "Pending",
+                              'status': "Job Submitted.",
+                              'job_details': job,
+                              'job_log': job_log})
+        return None
+
+    migrate_job_success = job["status"] == JOB_STATUS_SUCCESS
+    invalidate_cluster(cluster_name)
+    snapshot_cluster_task.delay(cluster_name)
     migrate_job_details = cluster_conn.GetJobStatus(migrate_job_id)
-    message = "Job Submitted."
-    job_status = "Pending"
-    self.update_state(state='JPENDING',
-                      meta={
-                          'percent': '20',
-                          'job_id': migrate_job_id,
-                          'job_status': job_status,
-                          'status': message,
-                          'job_details': migrate_job_details})
-
-    migrate_job_success = cluster_conn.WaitForJobCompletion(migrate_job_id)
-    migrate_job_details = cluster_conn.GetJobStatus(migrate_job_id)
+    instance_after = query_resource(cluster_name, "instance", ["pnode"],
+                                    ["=", "name", instance_name])
+    record_migration(cluster_name, instance_before, migrate_job_details,
+                     instance_after[0]["pnode"] if instance_after else None,
+                     migrate_job_success)
 
     if migrate_job_success:
         message = "Migration Complete!"
@@ -133,21 +1052,23 @@ def migrate_instance_task(self, instance_name, cluster_name):
 
     return {
         'percent': 100,
+        'instance_name': instance_name,
         'job_id': migrate_job_id,
         'job_status': job_status,
         'status': message,
-        'job_details': migrate_job_details
+        'job_details': migrate_job_details,
+        'job_log': job_log
         }
 
 
-@task(bind=True)
+@task(bind=True, base=ProgressTask)
 def shutdown_node_task(self, node_name, cluster_name):
     """
     After doing the nessecary checks, sends an ipmi command to shutdown
     and loops until it's off
     """
     cluster_conn = cluster_connection(cluster_name)
-    node_info = cluster_conn.GetNode(node_name)
+    node_info = get_node_info(node_name, cluster_name, fields=["pinst_cnt"])
 
     if node_info["pinst_cnt"] != 0:
         return 'Node is not empty. Refusing to proceed.'
@@ -155,7 +1076,7 @@ def shutdown_node_task(self, node_name, cluster_name):
     ipmi_info = get_ipmi_info(node_name, cluster_name)
 
     node_drain_job = cluster_conn.SetNodeRole(node_name, "offline")
-    cluster_conn.WaitForJobCompletion(node_drain_job)
+    wait_for_node_job(cluster_conn, node_drain_job, cluster_name, node_name)
 
     ipmi_status_cmd = ("ipmitool -H " + ipmi_info["host"] + " -U " +
                        ipmi_info["username"] + " -I lanplus -P " +
@@ -194,7 +1115,6 @@ def startup_node_task(node_name, cluster_name):
     can readd the node to the cluster
     """
     cluster_conn = cluster_connection(cluster_name)
-    node_info = cluster_conn.GetNode(node_name)
     ipmi_info = get_ipmi_info(node_name, cluster_name)
 
     ping_cmd = "ping -c 1 -w 1 " + node_name
@@ -217,12 +1137,155 @@ def startup_node_task(node_name, cluster_name):
 
     time.sleep(20)
     node_readd_job = cluster_conn.SetNodeRole(node_name, "regular")
-    node_readd_job_status = cluster_conn.WaitForJobCompletion(node_readd_job)
+    node_readd_job_status = wait_for_node_job(
+        cluster_conn, node_readd_job, cluster_name, node_name)
 
     maintenancetag_job = cluster_conn.DeleteNodeTags(node_name, ['maintenance'])
-    cluster_conn.WaitForJobCompletion(maintenancetag_job)
+    wait_for_node_job(cluster_conn, maintenancetag_job,
+                      cluster_name, node_name)
 
     if node_readd_job_status:
         return "Host is up."
     else:
         return "Host is up but coundn't read to cluster."
+
+@task(bind=True, acks_late=True, reject_on_worker_lost=True,
+      max_retries=None)
+def rolling_maintenance_task(self, node_names, cluster_name,
+                             max_out=MAX_NODES_OUT):
+    """
+    Patch a list of nodes: evacuate, shut down and start up each of them in
+    turn, readding it to the cluster.
+
+    The nodes go through these phases as a pipeline: while a node reboots
+    the next one is already being evacuated, with at most max_out nodes out
+    of the cluster at once. The task doesn't wait for the phases. It checks
+    their tasks, starts whatever may start and runs again every
+    MAINTENANCE_POLL_INTERVAL seconds until every node is done. Once a node
+    fails no new node is taken out, the ones already out are finished.
+
+    The task id is the maintenance id, see maintenance.py.
+    """
+    maintenance_id = self.request.id
+    maintenance = get_maintenance(maintenance_id)
+    if maintenance is None:
+        print("Begin rolling maintenance of nodes " + ", ".join(node_names))
+        maintenance = {'state': 'M_RUNNING',
+                       'nodes': dict((node_name, {'phase': 'pending',
+                                                  'task_id': None})
+                                     for node_name in node_names)}
+        register_job(maintenance_id, 'maintenance', cluster_name, node_names)
+        update_maintenance(maintenance_id, cluster_name=cluster_name,
+                           node_names=node_names, max_out=max_out,
+                           **maintenance)
+    if maintenance["state"] in FINAL_STATES:
+        return maintenance_id
+    nodes = maintenance["nodes"]
+    state = maintenance["state"]
+
+    for node_name in node_names:
+        if nodes[node_name]["phase"] in OUT_PHASES:
+            advance_maintenance_node(node_name, nodes[node_name],
+                                     cluster_name)
+            if nodes[node_name]["phase"] == 'failed':
+                print("Maintenance of " + node_name + " failed: " +
+                      nodes[node_name]["message"])
+                state = 'M_HALTED'
+
+    pending = [node_name for node_name in node_names
+               if nodes[node_name]["phase"] == 'pending']
+    if state == 'M_RUNNING' and pending and len(nodes_out(nodes)) < max_out:
+        secondaries = {}
+        for instance in query_resource(
+                cluster_name, "instance", ["pnode", "snodes"],
+                ["|"] + [["=", "pnode", node_name]
+                         for node_name in pending + nodes_out(nodes)]):
+            secondaries.setdefault(instance["pnode"], []).extend(
+                instance["snodes"] or [])
+        while len(nodes_out(nodes)) < max_out:
+            node_name = next_node(node_names, nodes, secondaries)
+            if node_name is None:
+                break
+            print("Taking " + node_name + " out for maintenance.")
+            nodes[node_name] = {
+                'phase': 'evacuating',
+                'task_id': start_maintenance_evacuation(node_name,
+                                                        cluster_name)}
+            pending.remove(node_name)
+    update_maintenance(maintenance_id, state=state, nodes=nodes)
+
+    if nodes_out(nodes) or (state == 'M_RUNNING' and pending):
+        raise self.retry(countdown=MAINTENANCE_POLL_INTERVAL)
+    if state == 'M_RUNNING':
+        end_maintenance(maintenance_id, 'SUCCESS')
+    else:
+        end_maintenance(maintenance_id, 'FAILURE')
+    return maintenance_id
+
+def start_maintenance_evacuation(node_name, cluster_name):
+    """
+    Start the evacuation of a node for a rolling maintenance.
+
+    @return: the evacuation id, that of the evacuation already running on
+        the node if there's one
+    """
+    evacuation_id = uuid()
+    running_id = lock_nodes(cluster_name, [node_name], evacuation_id)
+    if running_id is not None:
+        return running_id
+    evacuate_node_task.apply_async(kwargs={'node_name': node_name,
+                                           'cluster_name': cluster_name},
+                                   task_id=evacuation_id)
+    return evacuation_id
+
+def advance_maintenance_node(node_name, node, cluster_name):
+    """
+    Move a node of a rolling maintenance to its next phase once the task of
+    its current phase is done, or to failed with a message.
+
+    @param node: the node's dict in the maintenance record, updated in place
+    """
+    if node["phase"] == 'evacuating':
+        evacuation = get_evacuation(node["task_id"])
+        if evacuation is None or evacuation["state"] not in FINAL_STATES:
+            return
+        if evacuation["state"] == 'FAILURE':
+            node.update(phase='failed', message="Evacuation failed: " +
+                        str(evacuation.get("message")))
+        elif evacuation["status"]["inst_failed"]:
+            node.update(phase='failed', message="Instances left: " +
+                        ", ".join(evacuation["status"]["inst_failed"]))
+        elif get_node_info(node_name, cluster_name,
+                           fields=["pinst_cnt"])["pinst_cnt"]:
+            node.update(phase='failed', message="Node is not empty.")
+        else:
+            shutdown_task = shutdown_node_task.delay(node_name, cluster_name)
+            node.update(phase='shutting_down', task_id=shutdown_task.id)
+        return
+
+    phase_task = celery_app.AsyncResult(node["task_id"])
+    if not phase_task.ready():
+        return
+    if not phase_task.successful():
+        node.update(phase='failed', message=str(phase_task.result))
+    elif node["phase"] == 'shutting_down':
+        startup_task = startup_node_task.delay(node_name, cluster_name)
+        node.update(phase='starting_up', task_id=startup_task.id)
+    else:
+        node_info = get_node_info(node_name, cluster_name,
+                                  fields=["offline", "drained"])
+        if node_info["offline"] or node_info["drained"]:
+            node.update(phase='failed', message=str(phase_task.result))
+        else:
+            node.update(phase='done', task_id=None)
+
+@task()
+def snapshot_clusters_task():
+    """Periodic task, refreshes the inventory snapshot of every cluster."""
+    for cluster_name in GANETI_CLUSTER:
+        snapshot_cluster_task.delay(cluster_name)
+
+@task()
+def snapshot_cluster_task(cluster_name):
+    """Incrementally refresh the inventory snapshot of one cluster."""
+    return sync_cluster(cluster_name)
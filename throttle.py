@@ -0,0 +1,132 @@
+"""
+Limits on simultaneous migrations per source and per target node, and
+optionally per cluster.
+
+Every running migration holds a slot on the node it leaves, on the node it
+lands on when that's known, and on its cluster. Slots are members of a redis
+sorted set per node and direction, scored with the time they expire, so a
+migration whose worker died frees its slots after MIGRATION_SLOT_TTL
+seconds. Migrations that run longer renew their slots while they work (see
+renew_migration_slot).
+"""
+import time
+
+from redis_clients import redis_client
+
+# Sorted set of instance names migrating to or from a node
+MIGRATION_SLOTS_KEY = "nodEvac:migrations:{cluster}:{direction}:{node}"
+# Sorted set of instance names migrating anywhere in a cluster
+CLUSTER_MIGRATIONS_KEY = "nodEvac:migrations:{cluster}"
+
+# Migrations a node may receive at the same time
+MAX_INBOUND_MIGRATIONS = 2
+# Migrations a node may send at the same time, unless an evacuation sets its
+# own limit (its concurrency)
+MAX_OUTBOUND_MIGRATIONS = 3
+# Seconds after which a slot whose migration never reported back is freed
+MIGRATION_SLOT_TTL = 3600
+
+redis_conn = redis_client('state')
+
+# Push back the expiry of the slots an instance still holds, slots that
+# expired (and may have been given away) are left alone
+_RENEW_SLOT_SCRIPT = redis_conn.register_script("""
+for _, key in ipairs(KEYS) do
+    local expires = tonumber(redis.call('ZSCORE', key, ARGV[1]))
+    if expires and expires > tonumber(ARGV[2]) then
+        redis.call('ZADD', key, ARGV[3], ARGV[1])
+        redis.call('EXPIRE', key, ARGV[4])
+    end
+end
+""")
+
+
+def _slots_key(cluster, direction, node):
+    return MIGRATION_SLOTS_KEY.format(cluster=cluster, direction=direction,
+                                      node=node)
+
+
+def _slot_keys(cluster, source, target,
+               source_limit=MAX_OUTBOUND_MIGRATIONS, cluster_limit=None):
+    """Return [(key, limit)] for the slots a migration needs."""
+    slot_keys = [(CLUSTER_MIGRATIONS_KEY.format(cluster=cluster),
+                  cluster_limit),
+                 (_slots_key(cluster, 'outbound', source), source_limit)]
+    if target is not None:
+        slot_keys.append((_slots_key(cluster, 'inbound', target),
+                          MAX_INBOUND_MIGRATIONS))
+    return slot_keys
+
+
+def acquire_migration_slot(cluster, instance, source, target,
+                           source_limit=MAX_OUTBOUND_MIGRATIONS,
+                           cluster_limit=None):
+    """Reserve a slot on the source and the target node of a migration.
+
+    @param target: the target node, or None if Ganeti picks it (iallocator),
+        in which case only the source is limited
+    @param source_limit: limit for the source, e.g. the concurrency of an
+        evacuation
+    @param cluster_limit: maximum number of migrations in the whole cluster,
+        e.g. the budget of a batch evacuation. Unlimited if None, but the
+        migration still counts against other callers' limits.
+    @return: True if the migration may start, False if any limit is reached
+    """
+    slot_keys = _slot_keys(cluster, source, target, source_limit,
+                           cluster_limit)
+
+    def reserve(pipe):
+        now = time.time()
+        for key, limit in slot_keys:
+            if limit is not None and pipe.zcount(key, now, '+inf') >= limit:
+                return False
+        pipe.multi()
+        for key, _ in slot_keys:
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zadd(key, now + MIGRATION_SLOT_TTL, instance)
+            pipe.expire(key, MIGRATION_SLOT_TTL)
+        return True
+
+    return redis_conn.transaction(reserve, *[key for key, _ in slot_keys],
+                                  value_from_callable=True)
+
+
+def release_migration_slot(cluster, instance, source, target):
+    """Free the slots taken with acquire_migration_slot()."""
+    pipe = redis_conn.pipeline()
+    for key, _ in _slot_keys(cluster, source, target):
+        pipe.zrem(key, instance)
+    pipe.execute()
+
+
+def renew_migration_slot(cluster, instance, source, target):
+    """Keep the slots of a running migration for MIGRATION_SLOT_TTL more."""
+    now = time.time()
+    _RENEW_SLOT_SCRIPT(keys=[key for key, _ in _slot_keys(cluster, source,
+                                                          target)],
+                       args=[instance, now, now + MIGRATION_SLOT_TTL,
+                             MIGRATION_SLOT_TTL])
+
+
+def cluster_migrations(cluster):
+    """Number of migrations currently running in a cluster."""
+    return redis_conn.zcount(CLUSTER_MIGRATIONS_KEY.format(cluster=cluster),
+                             time.time(), '+inf')
+
+
+def outbound_migrations(cluster, node):
+    """Number of migrations currently leaving a node."""
+    return redis_conn.zcount(_slots_key(cluster, 'outbound', node),
+                             time.time(), '+inf')
+
+
+def inbound_migrations(cluster, nodes):
+    """Number of migrations currently landing on each of the given nodes.
+
+    @return: dict of node name to count
+    """
+    now = time.time()
+    pipe = redis_conn.pipeline()
+    for node in nodes:
+        pipe.zcount(_slots_key(cluster, 'inbound', node), now, '+inf')
+    return dict(zip(nodes, pipe.execute()))